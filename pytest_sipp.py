@@ -1,9 +1,27 @@
+import functools
+import glob
+import hashlib
+import errno
+import json
 import os.path
+import random
 import re
+import shutil
+import signal
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from collections import Counter, OrderedDict, namedtuple
 import pytest
-import pysipp
+# pysipp and the heavier standard library modules are imported where
+# they are used so sessions without SIPp tests never load them.
 from pytest_exceptional import PytestException
 from _pytest import fixtures
+from _pytest.main import wrap_session
 from _pytest.python import transfer_markers, Metafunc, PyobjMixin
 
 try:
@@ -11,9 +29,34 @@ try:
 except ImportError:
     from backports.shutil_which import which
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 SCENARIO_ROOT = None
 
+# Metrics recorded for every scenario run. The bool is true when a
+# larger value is a regression.
+METRICS = OrderedDict([
+    ('duration', True),
+    ('failed_ratio', True),
+    ('cps', False),
+    ('rt_p50', True),
+    ('rt_p90', True),
+    ('rt_p99', True),
+])
+
+DEFAULT_TOLERANCES = {
+    'duration': 0.25,
+    'failed_ratio': 0.01,  # absolute, not relative
+    'cps': 0.10,
+    'rt_p50': 0.25,
+    'rt_p90': 0.25,
+    'rt_p99': 0.50,
+}
+
 
 class SIPpNotFound(PytestException):
     """Missing dependencies error.
@@ -29,6 +72,16 @@ class SIPpNotFound(PytestException):
         tw.line()
 
 
+class SIPpRegression(AssertionError):
+    """A scenario performed worse than its recorded baseline.
+    """
+
+
+class SIPpRegressionWarning(UserWarning):
+    """A scenario performed worse than its recorded baseline.
+    """
+
+
 class SIPpTest(PyobjMixin, pytest.Item):
     def __init__(self, name, parent, obj, config=None, callspec=None,
                  keywords=None, session=None, fixtureinfo=None,
@@ -63,7 +116,1744 @@ class SIPpTest(PyobjMixin, pytest.Item):
         fixtures.fillfixtures(self)
 
 
+def agent_name(args):
+    """Guess the name pysipp gave an agent from its command line.
+    """
+    for flag in ('-sf', '-sn'):
+        if flag in args[:-1]:
+            value = args[args.index(flag) + 1]
+            return os.path.splitext(os.path.basename(value))[0]
+    return 'agent'
+
+
+def describe_args(args):
+    """Pick the command line and sockets out of SIPp's arguments.
+    """
+    info = {'cmd': ' '.join(args)}
+    for flag, key in (('-p', 'local_port'), ('-rsa', 'proxy')):
+        if flag in args[:-1]:
+            info[key] = args[args.index(flag) + 1]
+
+    addr_re = re.compile(r'^[\w.\-\[\]:]+:\d+$')
+    for prev, arg in zip(args, args[1:]):
+        if addr_re.match(arg) and prev not in ('-rsa', '-3pcc'):
+            info['remote'] = arg
+    return info
+
+
+class SIPpProcess(subprocess.Popen):
+    """An agent process which reports its launch and exit to the event
+    log and the watchdog once pysipp's runner collects it.
+    """
+    def __init__(self, args, events=None, nodeid=None, watchdog=None,
+                 statfile=None, **kwargs):
+        super(SIPpProcess, self).__init__(args, **kwargs)
+        self.started = time.time()
+        self.events = events
+        self.nodeid = nodeid
+        self.watchdog = watchdog
+        if events:
+            events.emit('launch', nodeid=nodeid, agent=agent_name(args),
+                        pid=self.pid, args=args)
+        if watchdog:
+            watchdog.track(self, args, statfile)
+
+    def communicate(self, *args, **kwargs):
+        streams = super(SIPpProcess, self).communicate(*args, **kwargs)
+        if self.watchdog:
+            self.watchdog.untrack(self)
+        if self.events:
+            self.events.emit('exit', nodeid=self.nodeid, pid=self.pid,
+                             returncode=self.returncode,
+                             duration=time.time() - self.started)
+        return streams
+
+
+# SIPp options taking a path, resolved before agents are started from
+# their run directory.
+PATH_FLAGS = ('-sf', '-oocsf', '-inf', '-stf', '-screen_file', '-log_file',
+              '-error_file', '-message_file', '-calldebug_file')
+
+# Scratch files of a run which are not worth archiving.
+SCRATCH_DIR = 'scratch'
+
+
+class SIPpSpawner(object):
+    """Stand-in for the :mod:`subprocess` module handed to pysipp's
+    ``PopenRunner`` so every agent runs from ``rundir``, also dumps its
+    statistics to a file there and runs with the tuning ``flags`` it
+    was not already given.
+    """
+    PIPE = subprocess.PIPE
+
+    def __init__(self, rundir, extra_args=(), events=None, nodeid=None,
+                 flags=None, watchdog=None):
+        self.rundir = rundir
+        self.extra_args = list(extra_args)
+        self.flags = flags or {}
+        self.events = events
+        self.nodeid = nodeid
+        self.watchdog = watchdog
+        self.statfiles = OrderedDict()
+        self.procs = []
+
+    def Popen(self, args, **kwargs):
+        name = agent_name(args)
+        statfile = os.path.join(self.rundir, '{}-{}.csv'.format(
+            len(self.statfiles), name))
+        self.statfiles[statfile] = name
+
+        args = list(args) + ['-trace_stat', '-stf', statfile]
+        args.extend(self.extra_args)
+        for flag, value in sorted(self.flags.items()):
+            if flag not in args:
+                args.extend([flag, str(value)])
+        for index, flag in enumerate(args[:-1]):
+            if flag in PATH_FLAGS:
+                args[index + 1] = os.path.abspath(args[index + 1])
+        kwargs.setdefault('cwd', self.rundir)
+        proc = SIPpProcess(args, events=self.events, nodeid=self.nodeid,
+                           watchdog=self.watchdog, statfile=statfile,
+                           **kwargs)
+        self.procs.append(proc)
+        return proc
+
+
+def new_runner(spawner):
+    """Ask pysipp's ``pysipp_new_runner`` hook for a runner and, when it
+    is the stock ``PopenRunner``, have it launch agents with ``spawner``.
+    Runners provided by other plugins are used as is.
+    """
+    import pysipp
+
+    runner = pysipp.plugin.mng.hook.pysipp_new_runner()
+    if (isinstance(runner, pysipp.launch.PopenRunner) and
+            runner.spm is subprocess):
+        runner.spm = spawner
+    return runner
+
+
+def shard_count(procs):
+    """Resolve the ``procs`` argument of ``sipp_test`` to a number.
+    """
+    import multiprocessing
+    if procs == 'auto':
+        return multiprocessing.cpu_count()
+    return int(procs or 1)
+
+
+def split_load(total, count, index):
+    """Return shard ``index``'s share of ``total`` split ``count`` ways.
+    """
+    share, remainder = divmod(total, count)
+    return share + (1 if index < remainder else 0)
+
+
+def media_ports(port):
+    """Return the ports SIPp binds for media on ``port``: RTP and RTCP
+    for both audio and video.
+    """
+    return range(port, port + 4)
+
+
+def port_free(host, port):
+    import socket
+    sock = socket.socket(socket.AF_INET6 if ':' in (host or '')
+                         else socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((host or '', port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def allocate_port(host, start, used, span=1):
+    """Return the first port from ``start`` onwards whose ``span``
+    ports are neither in ``used`` nor taken on ``host``, and add them
+    to ``used``.
+    """
+    port = start
+    while port + span <= 65536:
+        ports = range(port, port + span)
+        if (not used.intersection(ports) and
+                all(port_free(host, p) for p in ports)):
+            used.update(ports)
+            return port
+        port += span
+    raise RuntimeError('No free ports left from {}'.format(start))
+
+
+def split_injection_file(path, count, rundir):
+    """Deal the rows of a SIPp injection file round robin into ``count``
+    files, each keeping the original header line.
+    """
+    name, ext = os.path.splitext(os.path.basename(path))
+    paths = [os.path.join(rundir, '{}-{}{}'.format(name, index, ext))
+             for index in range(count)]
+    shards = [open(shard, 'w') for shard in paths]
+    try:
+        with open(path) as source:
+            header = source.readline()
+            for shard in shards:
+                shard.write(header)
+            for index, line in enumerate(source):
+                shards[index % count].write(line)
+    finally:
+        for shard in shards:
+            shard.close()
+    return paths
+
+
+class InjectionSpec(object):
+    """Declarative description of a SIPp injection file (``-inf``).
+
+    ``columns`` are :meth:`str.format` templates rendered for each of
+    the ``rows`` rows with ``n``, the row number counted from ``start``,
+    and every counter in ``ranges``, a mapping of names to ``(first,
+    step)`` pairs::
+
+        InjectionSpec(1000000, ['sub{n:07d}', 'secret{n}', '{ext}'],
+                      start=1, ranges={'ext': (20000, 1)})
+    """
+    def __init__(self, rows, columns, start=0, ranges=None,
+                 order='SEQUENTIAL', offset=0):
+        self.rows = rows
+        self.columns = list(columns)
+        self.start = start
+        self.ranges = dict(ranges or {})
+        self.order = order
+        self.offset = offset
+
+    def todict(self):
+        return {'rows': self.rows, 'columns': self.columns,
+                'start': self.start, 'ranges': self.ranges,
+                'order': self.order, 'offset': self.offset}
+
+    def digest(self):
+        spec = json.dumps(self.todict(), sort_keys=True)
+        return hashlib.sha1(spec.encode('utf-8')).hexdigest()
+
+    def shard(self, index, count):
+        """Return the spec of the ``index``th of ``count`` contiguous
+        partitions of this file's rows.
+        """
+        share, remainder = divmod(self.rows, count)
+        offset = self.offset + index * share + min(index, remainder)
+        return InjectionSpec(split_load(self.rows, count, index),
+                             self.columns, start=self.start,
+                             ranges=self.ranges, order=self.order,
+                             offset=offset)
+
+    def lines(self):
+        template = ';'.join(self.columns) + '\n'
+        ranges = sorted(self.ranges.items())
+        for row in range(self.offset, self.offset + self.rows):
+            counters = dict((name, first + step * row)
+                            for name, (first, step) in ranges)
+            yield template.format(n=self.start + row, **counters)
+
+    def write(self, path):
+        """Stream the file to ``path``, appearing there atomically.
+        """
+        partial = '{}.{}.tmp'.format(path, os.getpid())
+        with open(partial, 'w', 1 << 20) as fp:
+            fp.write(self.order + '\n')
+            fp.writelines(self.lines())
+        os.rename(partial, path)
+
+
+class SIPpInjectionCache(object):
+    """Injection files generated from their specs and cached across
+    sessions, dropping all but the ``keep`` most recently used of them
+    within ``max_size`` bytes once a session using the cache ends.
+    """
+    def __init__(self, directory, keep=None, max_size=None):
+        self.directory = directory
+        self.keep = keep
+        self.max_size = max_size
+
+    def path(self, spec):
+        path = os.path.join(self.directory, spec.digest() + '.csv')
+        try:
+            # Mark the file as recently used
+            os.utime(path, None)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            spec.write(path)
+        return path
+
+    def prune(self):
+        prune_files(glob.glob(os.path.join(self.directory, '*.csv')),
+                    self.keep, self.max_size)
+
+    @pytest.hookimpl
+    def pytest_unconfigure(self, config):
+        self.prune()
+
+
+def injection_file(config, spec):
+    """Return the path of the injection file described by ``spec``,
+    generating it unless an earlier session already cached it.
+    """
+    cache = config.pluginmanager.getplugin('sipp-injection')
+    if cache is None:
+        if not getattr(config, 'cache', None):
+            raise pytest.UsageError('injection files need the pytest cache')
+        max_size = config.getoption('--sipp-injection-max-size')
+        cache = SIPpInjectionCache(
+            str(config.cache.makedir('sipp_injection')),
+            config.getoption('--sipp-injection-keep'),
+            int(max_size * 1024 * 1024))
+        config.pluginmanager.register(cache, 'sipp-injection')
+    return cache.path(spec)
+
+
+def injection_shard_file(config, spec, index, count):
+    return injection_file(config, spec.shard(index, count))
+
+
+class SIPpShards(object):
+    """Run a scenario with its client agents sharded over ``count`` SIPp
+    processes, presented to the caller as a single pysipp run.
+
+    Every shard gets its own free local and media ports and a share of
+    the call rate, limit, count and injection file rows, the latter
+    generated by ``injection(index, count)`` when given. Server agents
+    are only launched with the first shard.
+    """
+    def __init__(self, sippscen, count, spawner, injection=None):
+        agents = sippscen.prepare()
+        clients = [ua for ua in agents if ua.is_client()]
+        # Every shard needs at least one call, and one of the limit
+        bounds = [int(getattr(ua, name) or 0)
+                  for ua in clients for name in ('call_count', 'limit')]
+        requested = count
+        count = min([count] + [bound for bound in bounds if bound])
+        reason = ("each needs at least one call of the client agents' "
+                  "call count and limit (-m and -l)")
+        if not clients:
+            count = 1
+            reason = 'the scenario has no client agents'
+        if count < requested:
+            warnings.warn('Running {} instead of {} SIPp processes, {}'
+                          .format(count, requested, reason))
+
+        self.used_ports = set()
+        for ua in agents:
+            if ua.local_port:
+                self.used_ports.add(int(ua.local_port))
+            if ua.media_port:
+                self.used_ports.update(media_ports(int(ua.media_port)))
+
+        self.runners = []
+        self.scenarios = []
+        self.finalizers = []
+        self.spawner = spawner
+        self.injection = injection
+        self.injection_files = {}
+        for index in range(count):
+            agents = [self.shard_agent(ua, index, count)
+                      for ua in sippscen.prepare()
+                      if ua.is_client() or index == 0]
+            self.scenarios.append(sippscen.from_agents(agents))
+            self.runners.append(new_runner(spawner))
+
+    def shard_agent(self, ua, index, count):
+        if not ua.is_client():
+            return ua
+
+        if index and ua.local_port:
+            ua.local_port = allocate_port(ua.local_host,
+                                          int(ua.local_port) + 1,
+                                          self.used_ports)
+        if index and ua.media_port:
+            ua.media_port = allocate_port(ua.local_host,
+                                          int(ua.media_port) + 4,
+                                          self.used_ports, span=4)
+        for name in ('screen_file', 'log_file', 'error_file',
+                     'message_file', 'calldebug_file'):
+            if getattr(ua, name):
+                setattr(ua, name, '{}-{}'.format(getattr(ua, name), index))
+        if ua.rate:
+            ua.rate = float(ua.rate) / count
+        if ua.limit:
+            ua.limit = split_load(int(ua.limit), count, index)
+        if ua.call_count:
+            ua.call_count = split_load(int(ua.call_count), count, index)
+        if self.injection:
+            ua.info_file = self.injection(index, count)
+        elif ua.info_file:
+            ua.info_file = self.injection_shards(ua.info_file, count)[index]
+        if ua.info_files:
+            ua.info_files = [self.injection_shards(path, count)[index]
+                             for path in ua.info_files]
+        return ua
+
+    def injection_shards(self, path, count):
+        if path not in self.injection_files:
+            scratch = os.path.join(self.spawner.rundir, SCRATCH_DIR)
+            if not os.path.isdir(scratch):
+                os.makedirs(scratch)
+            self.injection_files[path] = split_injection_file(
+                path, count, scratch)
+        return self.injection_files[path]
+
+    def launch(self, block=True, timeout=180, **kwargs):
+        if 'runner' in kwargs:
+            raise ValueError('Cannot shard a scenario with a custom runner')
+
+        for scen, runner in zip(self.scenarios, self.runners):
+            self.finalizers.append(scen(block=False, timeout=timeout,
+                                        runner=runner, **kwargs))
+        if block:
+            return self.finalize(timeout=timeout)
+        return self.finalize
+
+    def is_alive(self):
+        return any(runner.is_alive() for runner in self.runners)
+
+    def stop(self):
+        for runner in self.runners:
+            runner.stop()
+
+    def finalize(self, timeout=180, raise_exc=True):
+        import pysipp
+        deadline = time.time() + timeout
+        while self.is_alive() and time.time() < deadline:
+            # One failing shard fails the run, stop the others early
+            if any(proc.poll() not in (None, 0)
+                   for proc in self.spawner.procs):
+                self.stop()
+                break
+            time.sleep(0.1)
+
+        errors = []
+        for finalize in self.finalizers:
+            try:
+                finalize(timeout=max(deadline - time.time(), 0),
+                         raise_exc=raise_exc)
+            except pysipp.launch.TimeoutError as exc:
+                self.stop()
+                errors.insert(0, exc)
+            except pysipp.SIPpFailure as exc:
+                errors.append(exc)
+
+        if errors:
+            if isinstance(errors[0], pysipp.launch.TimeoutError):
+                raise errors[0]
+            raise pysipp.SIPpFailure('\n'.join(str(exc) for exc in errors))
+
+
+def rundir_base(path=None):
+    """Return where run directories are made, preferring ``path`` and
+    then a memory backed file system when the host has one.
+    """
+    if path:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def make_rundir(item):
+    """Create an isolated working directory for ``item``'s agents.
+    """
+    name = re.sub(r'[^\w.\-]+', '_', item.nodeid)[-60:]
+    return tempfile.mkdtemp(prefix=name + '-',
+                            dir=rundir_base(item.config.getoption(
+                                '--sipp-rundir')))
+
+
+def prune_files(paths, keep=None, max_size=None):
+    """Remove all but the ``keep`` newest of ``paths`` within ``max_size``
+    bytes. The newest file is always kept, however large, and files
+    another process removes meanwhile are skipped.
+    """
+    files = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    size = 0
+    for index, (_, filesize, path) in enumerate(sorted(files, reverse=True)):
+        size += filesize
+        if index and ((keep is not None and index >= keep) or
+                      (max_size is not None and size > max_size)):
+            try:
+                os.remove(path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+
+
+class SIPpArchive(object):
+    """Move finished run directories into a compressed per-session zip
+    from a background thread, dropping the oldest archives beyond
+    ``keep`` of them or ``max_size`` bytes once the session ends.
+    """
+    def __init__(self, directory, keep=None, max_size=None):
+        self.directory = directory
+        self.path = os.path.join(directory, 'sipp-{}-{}.zip'.format(
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        self.keep = keep
+        self.max_size = max_size
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def add(self, rundir, name):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write,
+                                           name='sipp-archive')
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((rundir, name))
+
+    def write(self):
+        import zipfile
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as archive:
+            while True:
+                job = self.queue.get()
+                if job is None:
+                    break
+
+                rundir, name = job
+                for root, dirs, files in os.walk(rundir):
+                    dirs[:] = [d for d in dirs if d != SCRATCH_DIR]
+                    for filename in sorted(files):
+                        path = os.path.join(root, filename)
+                        archive.write(path, os.path.join(
+                            name, os.path.relpath(path, rundir)))
+                shutil.rmtree(rundir, ignore_errors=True)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def prune(self):
+        prune_files(glob.glob(os.path.join(self.directory, 'sipp-*.zip')),
+                    self.keep, self.max_size)
+
+    @pytest.hookimpl
+    def pytest_unconfigure(self, config):
+        # Sessions which ran no scenario leave the archives alone
+        if self.thread is not None:
+            self.close()
+            self.prune()
+
+
+class SIPpEventLog(object):
+    """Stream scenario events as JSON lines from a background thread,
+    keeping serialisation and disk I/O off the test's critical path.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write,
+                                       name='sipp-event-log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        self.queue.put(fields)
+
+    def write(self):
+        with open(self.path, 'a') as fp:
+            while True:
+                fields = self.queue.get()
+                if fields is None:
+                    break
+
+                args = fields.pop('args', None)
+                if args is not None:
+                    fields.update(describe_args(args))
+                fp.write(json.dumps(fields, sort_keys=True) + '\n')
+                if self.queue.empty():
+                    fp.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_teardown(self, item, nextitem):
+        start = time.time()
+        yield
+        if issipptest(item):
+            self.emit('teardown', nodeid=item.nodeid,
+                      duration=time.time() - start)
+
+    @pytest.hookimpl
+    def pytest_unconfigure(self, config):
+        self.close()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def pid_cmdline(pid):
+    """Return the argument vector of a running process, or None when it
+    cannot be read.
+    """
+    try:
+        with open('/proc/{}/cmdline'.format(pid), 'rb') as fp:
+            return fp.read().decode('utf-8', 'replace').split('\0')[:-1]
+    except (IOError, OSError):
+        return None
+
+
+def kill_pid(pid, grace=2.0):
+    """SIGTERM a process, then SIGKILL it if it outlives ``grace``.
+    """
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            return
+        expires = time.time() + grace
+        while time.time() < expires:
+            if not pid_alive(pid):
+                return
+            time.sleep(0.05)
+
+
+def stat_progress(statfile):
+    """Return the call counters of an agent's latest stat dump.
+    """
+    row = statfile and os.path.exists(statfile) and parse_stat_file(statfile)
+    if not row:
+        return None
+    return tuple(row.get(column) for column in (
+        'TotalCallCreated', 'SuccessfulCall(C)', 'FailedCall(C)'))
+
+
+class SIPpWatchdog(object):
+    """Keep a per-session registry of every spawned agent so agents
+    orphaned by a killed session can be reaped by the next one, kill
+    our own stragglers when the session ends and, optionally, kill
+    agents whose statistics stop progressing.
+    """
+    def __init__(self, registry, hang_timeout=None):
+        self.registry = registry
+        self.path = os.path.join(registry, '{}.json'.format(os.getpid()))
+        self.hang_timeout = hang_timeout
+        self.lock = threading.Lock()
+        self.agents = {}
+        self.reaped = []
+        self.hung = []
+        self.stopped = threading.Event()
+
+    def track(self, proc, args, statfile):
+        info = describe_args(args)
+        info['started'] = time.time()
+        with self.lock:
+            self.agents[proc.pid] = [proc, info, statfile, None, time.time()]
+            self.save()
+
+    def untrack(self, proc):
+        with self.lock:
+            if self.agents.pop(proc.pid, None):
+                self.save()
+
+    def save(self):
+        registry = {'owner': os.getpid(),
+                    'agents': dict((str(pid), agent[1])
+                                   for pid, agent in self.agents.items())}
+        partial = self.path + '.tmp'
+        with open(partial, 'w') as fp:
+            json.dump(registry, fp)
+        os.rename(partial, self.path)
+
+    def reap_orphans(self):
+        """Kill agents registered by sessions which no longer exist.
+        """
+        for path in glob.glob(os.path.join(self.registry, '*.json')):
+            try:
+                with open(path) as fp:
+                    registry = json.load(fp)
+                owner = int(registry['owner'])
+                agents = [(int(pid), info, info['cmd'].split()[0])
+                          for pid, info in registry['agents'].items()]
+            except (IOError, OSError, ValueError, TypeError, KeyError,
+                    AttributeError, IndexError):
+                continue
+            if pid_alive(owner):
+                continue
+
+            for pid, info, binary in agents:
+                cmdline = pid_cmdline(pid)
+                # Never kill a process that merely reused an agent's pid
+                if cmdline and binary in cmdline:
+                    kill_pid(pid)
+                    self.reaped.append((pid, info))
+            try:
+                os.remove(path)
+            except OSError as exc:
+                # Another session starting alongside reaped it first
+                if exc.errno != errno.ENOENT:
+                    raise
+
+    def check_hung(self):
+        while not self.stopped.wait(max(self.hang_timeout / 10., 1)):
+            now = time.time()
+            with self.lock:
+                agents = list(self.agents.values())
+            for agent in agents:
+                proc, info, statfile, progress, changed = agent
+                current = stat_progress(statfile)
+                if current != progress:
+                    agent[3:] = [current, now]
+                elif (now - changed > self.hang_timeout and
+                        proc.poll() is None):
+                    proc.kill()
+                    self.hung.append((proc.pid, info))
+
+    def start(self):
+        self.reap_orphans()
+        if self.hang_timeout:
+            thread = threading.Thread(target=self.check_hung,
+                                      name='sipp-watchdog')
+            thread.daemon = True
+            thread.start()
+
+    @pytest.hookimpl
+    def pytest_sessionfinish(self, session):
+        self.stopped.set()
+        with self.lock:
+            agents = list(self.agents.values())
+        for proc, info, _, _, _ in agents:
+            if proc.poll() is None:
+                kill_pid(proc.pid)
+                self.reaped.append((proc.pid, info))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @pytest.hookimpl
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.reaped and not self.hung:
+            return
+
+        terminalreporter.section('sipp watchdog')
+        for title, agents in (('killed stray agent', self.reaped),
+                              ('killed hung agent', self.hung)):
+            for pid, info in agents:
+                terminalreporter.line('{} {}: {}'.format(
+                    title, pid, info['cmd']))
+
+
+class LazyFormat(object):
+    """Defer building an expensive log message until a handler actually
+    formats the record.
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def parse_sipp_time(value):
+    """Convert SIPp's ``HH:MM:SS:usec`` stat timestamps to seconds.
+    """
+    fields = [float(field) for field in value.split(':')]
+    seconds = 0.0
+    for field, scale in zip(fields, (3600, 60, 1, 1e-6)):
+        seconds += field * scale
+    return seconds
+
+
+def parse_stat_file(path):
+    """Return the last row of a SIPp ``-trace_stat`` file as a dict.
+    """
+    header = row = None
+    with open(path) as statfile:
+        for line in statfile:
+            fields = line.rstrip().rstrip(';').split(';')
+            if header is None:
+                header = fields
+            elif fields != [''] and len(fields) == len(header):
+                row = fields
+    if not row:
+        return None
+    return dict(zip(header, row))
+
+
+def percentile(histogram, fraction):
+    """Estimate a percentile from ``(upper bound, count)`` pairs.
+    """
+    total = sum(count for _, count in histogram)
+    if not total:
+        return None
+
+    seen = 0
+    for bound, count in histogram:
+        seen += count
+        if seen >= fraction * total:
+            return bound
+    return histogram[-1][0]
+
+
+def agent_rows(statfiles):
+    """Return the latest stat rows of the agents that count calls.
+    """
+    stats = [(name, parse_stat_file(path))
+             for path, name in statfiles.items() if os.path.exists(path)]
+    stats = [(name, row) for name, row in stats if row]
+
+    # Calls are counted where they originate, unless the scenario
+    # only has servers.
+    clients = [row for name, row in stats if 'uac' in name.lower()]
+    return clients or [row for _, row in stats]
+
+
+def total(rows, column, cast=int):
+    return sum(cast(row.get(column) or 0) for row in rows)
+
+
+def collect_metrics(statfiles, duration):
+    """Roll up the per-agent stat files of one run into scenario metrics.
+    """
+    metrics = {'duration': duration}
+    rows = agent_rows(statfiles)
+    if not rows:
+        return metrics
+
+    calls = total(rows, 'TotalCallCreated')
+    failed = total(rows, 'FailedCall(C)')
+    metrics['calls'] = calls
+    metrics['successful'] = total(rows, 'SuccessfulCall(C)')
+    metrics['failed'] = failed
+    metrics['failed_ratio'] = float(failed) / calls if calls else 0.0
+    metrics['cps'] = total(rows, 'CallRate(C)', float)
+
+    buckets = {}
+    bucket_re = re.compile(r'ResponseTimeRepartition1_(?:<|>=)(\d+)$')
+    for row in rows:
+        for column, value in row.items():
+            match = bucket_re.match(column)
+            if match and value:
+                bound = int(match.group(1))
+                buckets[bound] = buckets.get(bound, 0) + int(value)
+
+    histogram = sorted(buckets.items())
+    for name, fraction in (('rt_p50', .5), ('rt_p90', .9), ('rt_p99', .99)):
+        value = percentile(histogram, fraction)
+        if value is not None:
+            metrics[name] = value
+    return metrics
+
+
+def compare_metrics(baseline, metrics, tolerances=None):
+    """Return a description of every metric that regressed beyond its
+    tolerance relative to ``baseline``.
+    """
+    limits = dict(DEFAULT_TOLERANCES)
+    limits.update(tolerances or {})
+
+    regressions = []
+    for name, higher_is_worse in METRICS.items():
+        base, value = baseline.get(name), metrics.get(name)
+        if base is None or value is None:
+            continue
+
+        tolerance = limits.get(name, 0)
+        if name == 'failed_ratio':
+            bound = base + tolerance
+        elif higher_is_worse:
+            bound = base * (1 + tolerance)
+        else:
+            bound = base * (1 - tolerance)
+
+        if value > bound if higher_is_worse else value < bound:
+            regressions.append('{}: {:g} vs baseline {:g} (limit {:g})'.format(
+                name, value, base, bound))
+    return regressions
+
+
+class SIPpBaseline(object):
+    """Compare scenario metrics against a named baseline kept in the
+    pytest cache or in a JSON results file.
+    """
+    def __init__(self, config, name):
+        self.config = config
+        self.name = name
+        self.path = config.getoption('--sipp-baseline-file')
+        if not self.path and not getattr(config, 'cache', None):
+            raise pytest.UsageError('--sipp-baseline needs the pytest cache '
+                                    'or --sipp-baseline-file')
+        self.update = config.getoption('--sipp-baseline-update')
+        self.warn = config.getoption('--sipp-regressions') == 'warn'
+        self.tolerances = parse_tolerances(
+            config.getoption('--sipp-tolerance') or [])
+        self.baseline = self.load()
+        self.recorded = {}
+
+    @property
+    def cachekey(self):
+        return 'sipp/baseline/{}'.format(self.name)
+
+    def load(self):
+        if self.path:
+            if not os.path.exists(self.path):
+                return {}
+            with open(self.path) as fp:
+                return json.load(fp).get(self.name, {})
+        return self.config.cache.get(self.cachekey, {})
+
+    def lockpath(self):
+        if self.path:
+            return self.path + '.lock'
+        lockdir = self.config.cache.makedir('sipp_baseline')
+        return str(lockdir.join(re.sub(r'[^\w.\-]+', '_', self.name) +
+                                '.lock'))
+
+    def save(self):
+        import fcntl
+        # Other sessions (e.g. xdist workers) record into the same
+        # baseline, merge with whatever they saved since it was loaded
+        with open(self.lockpath(), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            baseline = self.load()
+            baseline.update(self.recorded)
+            if not self.path:
+                self.config.cache.set(self.cachekey, baseline)
+                return
+
+            results = {}
+            if os.path.exists(self.path):
+                with open(self.path) as fp:
+                    results = json.load(fp)
+            results[self.name] = baseline
+            with open(self.path, 'w') as fp:
+                json.dump(results, fp, indent=2, sort_keys=True)
+
+    @pytest.hookimpl
+    def pytest_sipp_scenario_metrics(self, item, sippscen, metrics):
+        if getattr(item, 'sipp_reused', None):
+            # Already compared (or recorded) under the run it came from
+            return
+
+        baseline = self.baseline.get(item.nodeid)
+        if self.update or baseline is None:
+            self.recorded[item.nodeid] = metrics
+            return
+
+        regressions = compare_metrics(baseline, metrics, self.tolerances)
+        if not regressions:
+            return
+
+        msg = "{} regressed against baseline '{}':\n    {}".format(
+            item.nodeid, self.name, '\n    '.join(regressions))
+        if self.warn:
+            warnings.warn(SIPpRegressionWarning(msg))
+        else:
+            raise SIPpRegression(msg)
+
+    @pytest.hookimpl
+    def pytest_sessionfinish(self, session):
+        if self.recorded:
+            self.save()
+
+
+def parse_tolerances(values):
+    tolerances = {}
+    for value in values:
+        name, _, tolerance = value.partition('=')
+        if name not in METRICS or not tolerance:
+            raise pytest.UsageError(
+                "Invalid --sipp-tolerance '{}', expected one of {} "
+                "followed by '=<fraction>'".format(value, ', '.join(METRICS)))
+        tolerances[name] = float(tolerance)
+    return tolerances
+
+
+HISTORY_COLUMNS = (
+    'started', 'session', 'nodeid', 'scenario', 'dut', 'outcome',
+    'test_duration', 'duration', 'calls', 'successful', 'failed', 'cps',
+    'failed_ratio', 'rt_p50', 'rt_p90', 'rt_p99',
+)
+
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    started REAL NOT NULL,
+    session TEXT NOT NULL,
+    nodeid TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    dut TEXT,
+    outcome TEXT NOT NULL,
+    test_duration REAL,
+    duration REAL,
+    calls INTEGER,
+    successful INTEGER,
+    failed INTEGER,
+    cps REAL,
+    failed_ratio REAL,
+    rt_p50 REAL,
+    rt_p90 REAL,
+    rt_p99 REAL
+);
+CREATE INDEX IF NOT EXISTS runs_by_scenario ON runs (scenario, started);
+CREATE INDEX IF NOT EXISTS runs_by_time ON runs (started);
+'''
+
+
+def history_path(config):
+    path = config.getoption('--sipp-history-db')
+    if not path and getattr(config, 'cache', None):
+        path = str(config.cache.makedir('sipp_history').join('history.db'))
+    return path
+
+
+def open_history(path):
+    import sqlite3
+    db = sqlite3.connect(path, timeout=30)
+    db.executescript(HISTORY_SCHEMA)
+    return db
+
+
+def scenario_name(item):
+    """Name a SIPp test's scenario by its directory, relative to the
+    scenario root when it lives there.
+    """
+    dirpath = getattr(item.funcargs.get('sippscen'), 'dirpath', None)
+    if isinstance(dirpath, str):
+        if SCENARIO_ROOT:
+            root = os.path.join(os.path.abspath(SCENARIO_ROOT), '')
+            if os.path.abspath(dirpath).startswith(root):
+                return os.path.relpath(dirpath, root)
+        return dirpath
+    callspec = getattr(item, 'callspec', None)
+    return callspec.id if callspec else item.name
+
+
+class SIPpHistory(object):
+    """Append the outcome and metrics of every SIPp test to a SQLite
+    store as soon as it is reported, so the runs of a session killed
+    halfway through are kept.
+    """
+    def __init__(self, path, dut=None):
+        self.path = path
+        self.dut = dut
+        self.session = uuid.uuid4().hex
+        self.db = None
+
+    def dut_name(self, item):
+        if self.dut:
+            return self.dut
+        addr = item.funcargs.get('sipp_proxyaddr')
+        if addr:
+            return '{}:{}'.format(*addr)
+        return item.funcargs.get('dut_ip')
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        report = outcome.get_result()
+        if not isinstance(item, SIPpTest):
+            return
+        if call.when != 'call' and (call.when != 'setup' or report.passed):
+            return
+        if getattr(item, 'sipp_reused', None):
+            # The run it reused is already recorded
+            return
+
+        metrics = getattr(item, 'sipp_metrics', None) or {}
+        row = dict((column, metrics.get(column))
+                   for column in HISTORY_COLUMNS)
+        row.update(started=call.start, session=self.session,
+                   nodeid=item.nodeid, scenario=scenario_name(item),
+                   dut=self.dut_name(item), outcome=report.outcome,
+                   test_duration=call.stop - call.start)
+        if self.db is None:
+            self.db = open_history(self.path)
+        with self.db:
+            self.db.execute('INSERT INTO runs ({}) VALUES ({})'.format(
+                ', '.join(HISTORY_COLUMNS),
+                ', '.join('?' * len(HISTORY_COLUMNS))),
+                tuple(row[column] for column in HISTORY_COLUMNS))
+
+    @pytest.hookimpl
+    def pytest_sessionfinish(self, session):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def history_report(config, session):
+    """Print the daily trend of a scenario's recorded runs.
+    """
+    tw = config.get_terminal_writer()
+    scenario = config.getoption('--sipp-history')
+    days = config.getoption('--sipp-history-days')
+    path = history_path(config)
+    if not path:
+        raise pytest.UsageError('--sipp-history needs the pytest cache or '
+                                '--sipp-history-db')
+    db = open_history(path)
+    try:
+        trend = db.execute('''
+            SELECT date(started, 'unixepoch', 'localtime') AS day,
+                   count(*), sum(outcome = 'passed'), avg(duration),
+                   avg(cps), avg(failed_ratio), max(rt_p99)
+            FROM runs
+            WHERE scenario = ? AND started >= ?
+            GROUP BY day ORDER BY day
+        ''', (scenario, time.time() - days * 86400)).fetchall()
+        if not trend:
+            known = [row[0] for row in db.execute(
+                'SELECT DISTINCT scenario FROM runs ORDER BY scenario')]
+            tw.line("No runs of scenario '{}' in the last {:g} days".format(
+                scenario, days), red=True)
+            if known:
+                tw.line('Recorded scenarios: {}'.format(', '.join(known)))
+            return
+    finally:
+        db.close()
+
+    def fmt(template, value):
+        return '-' if value is None else template.format(value)
+
+    tw.line("Scenario '{}', last {:g} days".format(scenario, days),
+            bold=True)
+    tw.line('{:<10} {:>6} {:>6} {:>10} {:>8} {:>8} {:>8}'.format(
+        'day', 'runs', 'passed', 'duration', 'cps', 'failed', 'rt_p99'))
+    for day, runs, passed, duration, cps, failed, rt_p99 in trend:
+        tw.line('{:<10} {:>6} {:>6} {:>10} {:>8} {:>8} {:>8}'.format(
+            day, runs, passed, fmt('{:.1f}s', duration), fmt('{:.1f}', cps),
+            fmt('{:.2%}', failed), fmt('{:g}ms', rt_p99)))
+
+
+SOAK_RECORD = struct.Struct('<Bdqqqqdd')
+
+
+class SoakCheckpoint(namedtuple('SoakCheckpoint', 'kind timestamp created '
+                                'successful failed current cps rt')):
+    """One fixed-size record of a soak log, rolled up over all agents.
+    """
+    START, CHECKPOINT, END = range(3)
+
+    @classmethod
+    def from_rows(cls, rows, kind=1):
+        rt = [parse_sipp_time(row['ResponseTime1(C)'])
+              for row in rows if row.get('ResponseTime1(C)')]
+        return cls(kind, time.time(),
+                   total(rows, 'TotalCallCreated'),
+                   total(rows, 'SuccessfulCall(C)'),
+                   total(rows, 'FailedCall(C)'),
+                   total(rows, 'CurrentCall'),
+                   total(rows, 'CallRate(C)', float),
+                   1000 * max(rt) if rt else 0.0)
+
+    @classmethod
+    def marker(cls, kind):
+        return cls(kind, time.time(), 0, 0, 0, 0, 0.0, 0.0)
+
+
+class SoakSummary(object):
+    """Aggregates of a single soak run that stay the same size however
+    long the run lasts.
+    """
+    def __init__(self, started):
+        self.started = self.updated = started
+        self.checkpoints = 0
+        self.first = self.last = None
+        self.max_current = 0
+        self.completed = False
+
+    def update(self, checkpoint):
+        self.updated = checkpoint.timestamp
+        if checkpoint.kind == SoakCheckpoint.END:
+            self.completed = True
+            return
+
+        self.checkpoints += 1
+        self.first = self.first or checkpoint
+        self.last = checkpoint
+        self.max_current = max(self.max_current, checkpoint.current)
+
+    def __str__(self):
+        hours = (self.updated - self.started) / 3600.
+        started = time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(self.started))
+        if not self.last:
+            return 'run started {}, no checkpoints after {:.2f}h{}'.format(
+                started, hours, '' if self.completed else ' (crashed)')
+        return ('run started {}, {} checkpoints over {:.2f}h: {} calls, '
+                '{} failed, {:.1f} cps, current calls {} -> {} (max {}){}'
+                .format(started, self.checkpoints, hours, self.last.created,
+                        self.last.failed, self.last.cps, self.first.current,
+                        self.last.current, self.max_current,
+                        '' if self.completed else ' (crashed)'))
+
+
+class SoakLog(object):
+    """Append-only file of fixed-size soak checkpoints.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, checkpoint):
+        with open(self.path, 'ab') as fp:
+            fp.write(SOAK_RECORD.pack(*checkpoint))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def __iter__(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as fp:
+            while True:
+                data = fp.read(SOAK_RECORD.size)
+                # A short read is a record torn by a crash
+                if len(data) < SOAK_RECORD.size:
+                    return
+                yield SoakCheckpoint(*SOAK_RECORD.unpack(data))
+
+    def runs(self):
+        """Summarise every run recorded in the log, oldest first.
+        """
+        summary = None
+        for checkpoint in self:
+            if checkpoint.kind == SoakCheckpoint.START:
+                if summary:
+                    yield summary
+                summary = SoakSummary(checkpoint.timestamp)
+            elif summary:
+                summary.update(checkpoint)
+        if summary:
+            yield summary
+
+
+def no_call_leak(slack=0, warmup=1):
+    """Soak check failing once concurrent calls grow more than ``slack``
+    above the level seen after ``warmup`` checkpoints.
+    """
+    reference = []
+
+    def check(checkpoint, summary):
+        if summary.checkpoints == warmup:
+            reference.append(checkpoint.current)
+        elif reference and checkpoint.current > reference[0] + slack:
+            raise AssertionError(
+                'Current calls grew from {} to {} during soak'.format(
+                    reference[0], checkpoint.current))
+    return check
+
+
+def max_failed_ratio(ratio):
+    """Soak check failing once the failed call ratio exceeds ``ratio``.
+    """
+    def check(checkpoint, summary):
+        if (checkpoint.created and
+                float(checkpoint.failed) / checkpoint.created > ratio):
+            raise AssertionError(
+                '{} of {} calls failed during soak'.format(
+                    checkpoint.failed, checkpoint.created))
+    return check
+
+
+def soak_log_path(item):
+    soak_dir = sipp_dir(item.config, '--sipp-soak-dir', 'sipp_soak')
+    if not soak_dir:
+        raise pytest.UsageError('soak runs need the pytest cache or '
+                                '--sipp-soak-dir')
+    return os.path.join(soak_dir, re.sub(r'[^\w.-]+', '_', item.nodeid))
+
+
+def stop_soak(runner, finalize):
+    """Stop the agents of a soak run and collect them, ignoring how they
+    exited.
+    """
+    import pysipp
+    runner.stop()
+    try:
+        finalize(timeout=10, raise_exc=False)
+    except pysipp.launch.TimeoutError as exc:
+        pytest.log.warning('Soak agents did not stop: {}'.format(exc))
+
+
+def run_soak(item, launch, runner, sippargs, timeout, interval, checks,
+             statfiles):
+    """Run a scenario while checkpointing its statistics every
+    ``interval`` seconds and enforcing the soak ``checks``.
+    """
+    log = SoakLog(soak_log_path(item))
+    for previous in log.runs():
+        if not previous.completed:
+            pytest.log.warning('Previous soak of {} did not finish: {}'
+                               .format(item.nodeid, previous))
+
+    log.append(SoakCheckpoint.marker(SoakCheckpoint.START))
+    summary = SoakSummary(time.time())
+
+    finalize = launch(block=False, timeout=timeout, **sippargs)
+    deadline = summary.started + timeout
+    due = summary.started + interval
+    try:
+        while runner.is_alive() and time.time() < deadline:
+            time.sleep(min(1, interval))
+            if time.time() < due:
+                continue
+            due += interval
+
+            checkpoint = SoakCheckpoint.from_rows(agent_rows(statfiles))
+            log.append(checkpoint)
+            summary.update(checkpoint)
+            for check in checks:
+                check(checkpoint, summary)
+    except Exception:
+        stop_soak(runner, finalize)
+        raise
+    else:
+        if runner.is_alive():
+            # The soak lasted its whole duration, which is a success
+            stop_soak(runner, finalize)
+        else:
+            finalize(timeout=10)
+    finally:
+        end = SoakCheckpoint.marker(SoakCheckpoint.END)
+        log.append(end)
+        summary.update(end)
+        item.add_report_section('call', 'sipp soak', '\n'.join(
+            str(run) for run in log.runs()))
+        pytest.log.info('Soak of {}: {}'.format(item.nodeid, summary))
+
+
+SIP_OPTIONS = (
+    'OPTIONS sip:{host}:{port} SIP/2.0\r\n'
+    'Via: SIP/2.0/UDP {lhost}:{lport};branch=z9hG4bK{tag};rport\r\n'
+    'Max-Forwards: 70\r\n'
+    'From: <sip:pytest-sipp@{lhost}>;tag={tag}\r\n'
+    'To: <sip:{host}:{port}>\r\n'
+    'Call-ID: {tag}@{lhost}\r\n'
+    'CSeq: 1 OPTIONS\r\n'
+    'Contact: <sip:pytest-sipp@{lhost}:{lport}>\r\n'
+    'Accept: application/sdp\r\n'
+    'Content-Length: 0\r\n\r\n'
+)
+
+
+def sip_host(host):
+    """Bracket IPv6 literals for use in SIP URIs and headers.
+    """
+    return '[{}]'.format(host) if ':' in host else host
+
+
+def probe_sip(addr, deadline=5.0, backoff=0.05, max_backoff=1.0):
+    """Send SIP OPTIONS to ``addr`` until anything answers with a SIP
+    response, doubling the wait between attempts. Return whether the
+    peer answered before ``deadline`` seconds passed.
+    """
+    import socket
+    host, port = addr[0].strip('[]'), int(addr[1])
+    family = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0][0]
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.connect((host, port))
+        lhost, lport = sock.getsockname()[:2]
+        request = SIP_OPTIONS.format(host=sip_host(host), port=port,
+                                     lhost=sip_host(lhost), lport=lport,
+                                     tag=uuid.uuid4().hex)
+
+        expires = time.time() + deadline
+        while True:
+            remaining = expires - time.time()
+            if remaining <= 0:
+                return False
+
+            wait = min(backoff, remaining)
+            sent = time.time()
+            try:
+                sock.send(request.encode('ascii'))
+                sock.settimeout(wait)
+                if sock.recv(65535).startswith(b'SIP/2.0 '):
+                    return True
+            except socket.timeout:
+                pass
+            except socket.error:
+                # ICMP port unreachable, nobody is listening yet
+                time.sleep(max(wait - (time.time() - sent), 0))
+            backoff = min(backoff * 2, max_backoff)
+    finally:
+        sock.close()
+
+
+class SIPpProbe(object):
+    """Check the DUT answers SIP OPTIONS before every scenario launch,
+    and give up on it for the rest of the session once it does not.
+    """
+    def __init__(self, config):
+        self.deadline = config.getoption('--sipp-probe-deadline')
+        self.skip = config.getoption('--sipp-probe-down') == 'skip'
+        self.down = set()
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_run_sipp_scenario(self, item, sippscen, sippargs):
+        addr = item.funcargs.get('sipp_proxyaddr')
+        if addr is None:
+            addr = item._request.getfixturevalue('sipp_proxyaddr')
+        addr = addr[0], int(addr[1])
+
+        if addr not in self.down and not probe_sip(addr, self.deadline):
+            self.down.add(addr)
+        if addr in self.down:
+            msg = 'DUT at {}:{} is not answering SIP OPTIONS'.format(*addr)
+            if self.skip:
+                pytest.skip(msg)
+            pytest.fail(msg, pytrace=False)
+
+
+SIP_REASONS = {
+    100: 'Trying',
+    200: 'OK',
+    202: 'Accepted',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+}
+
+SIP_COMPACT_HEADERS = {'v': 'via', 'f': 'from', 't': 'to', 'i': 'call-id'}
+
+SIP_SDP = (
+    'v=0\r\n'
+    'o=pytest-sipp 1 1 IN IP4 {host}\r\n'
+    's=-\r\n'
+    'c=IN IP4 {host}\r\n'
+    't=0 0\r\n'
+    'm=audio 6000 RTP/AVP 0\r\n'
+    'a=rtpmap:0 PCMU/8000\r\n'
+)
+
+
+class SIPResponder(object):
+    """Local stand-in for a DUT answering SIP over UDP from an asyncio
+    event loop running in a background thread.
+
+    INVITE is answered with 100 Trying and then 200 OK, BYE, CANCEL and
+    OPTIONS with 200 OK and REFER with 202 Accepted. ``delays`` maps
+    methods to how many seconds their final response is held back and
+    ``error_rates`` to the fraction of them answered with 503 Service
+    Unavailable instead.
+    """
+    ANSWERS = {'INVITE': 200, 'ACK': None, 'BYE': 200, 'CANCEL': 200,
+               'OPTIONS': 200, 'REFER': 202}
+
+    def __init__(self, host='127.0.0.1', port=0, delays=None,
+                 error_rates=None, seed=None):
+        self.host = host
+        self.port = port
+        self.delays = dict(delays or {})
+        self.error_rates = dict(error_rates or {})
+        self.random = random.Random(seed)
+        self.received = Counter()
+        self.answered = Counter()
+        self.loop = None
+        self.transport = None
+        self.thread = None
+
+    @property
+    def addr(self):
+        return self.transport.get_extra_info('sockname')[:2]
+
+    def start(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self.host, self.port)))
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='sip-responder')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        # Let the transport close its socket before the loop goes away
+        self.transport.close()
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        lines = data.decode('utf-8', 'replace').split('\r\n\r\n', 1)[0]
+        lines = lines.split('\r\n')
+        method = lines[0].split(' ', 1)[0]
+        if method == 'SIP/2.0':
+            return  # a response, nothing to answer
+
+        self.received[method] += 1
+        code = self.ANSWERS.get(method, 501)
+        if code is None:
+            return
+        if method == 'INVITE':
+            self.respond(lines, 100, addr)
+        if self.random.random() < self.error_rates.get(method, 0):
+            code = 503
+
+        delay = self.delays.get(method)
+        if delay:
+            self.loop.call_later(delay, self.respond, lines, code, addr)
+        else:
+            self.respond(lines, code, addr)
+
+    def respond(self, lines, code, addr):
+        headers = []
+        callid = ''
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            name = SIP_COMPACT_HEADERS.get(name, name)
+            if name == 'call-id':
+                callid = value.strip()
+            if name in ('via', 'from', 'to', 'call-id', 'cseq'):
+                headers.append((name, line))
+
+        # The same To tag for the whole dialog
+        tag = hashlib.sha1(callid.encode('utf-8')).hexdigest()[:10]
+        headers = [line + ';tag=' + tag
+                   if name == 'to' and code != 100 and ';tag=' not in line
+                   else line for name, line in headers]
+
+        body = ''
+        if code == 200 and lines[0].startswith('INVITE '):
+            body = SIP_SDP.format(host=self.addr[0])
+            headers.extend([
+                'Contact: <sip:pytest-sipp@{}:{}>'.format(*self.addr),
+                'Content-Type: application/sdp'])
+        headers.append('Content-Length: {}'.format(len(body)))
+
+        status = 'SIP/2.0 {} {}'.format(code, SIP_REASONS[code])
+        message = '\r\n'.join([status] + headers) + '\r\n\r\n' + body
+        self.transport.sendto(message.encode('utf-8'), addr)
+        self.answered[code] += 1
+
+
+class SIPResponderStandIn(object):
+    """Point ``sipp_proxyaddr`` at the local SIP responder instead of the
+    dut, registered with ``--sip-responder``.
+    """
+    @pytest.fixture(scope='session')
+    def sipp_proxyaddr(self, sip_responder):
+        '''Return the local SIP responder's socket.
+        '''
+        return sip_responder.addr
+
+
+def parse_method_values(option, values):
+    parsed = {}
+    for value in values or ():
+        method, _, number = value.partition('=')
+        try:
+            parsed[method.upper()] = float(number)
+        except ValueError:
+            raise pytest.UsageError(
+                "Invalid {} '{}', expected <METHOD>=<number>".format(
+                    option, value))
+    return parsed
+
+
+def hash_scenario_dir(dirpath):
+    """Hash the names and contents of every file in a scenario directory.
+    """
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(dirpath)):
+        path = os.path.join(dirpath, name)
+        if os.path.isfile(path):
+            digest.update(name.encode('utf-8'))
+            with open(path, 'rb') as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()
+
+
+class SIPpMemo(object):
+    """Reuse the outcome of an identical scenario run from earlier in
+    the session instead of launching SIPp again.
+
+    Runs are identical when they render the same agent command lines,
+    their scenario directories have the same content and they target
+    the same DUT.
+    """
+    def __init__(self):
+        self.outcomes = {}
+        self.reused = []
+        self.dirhashes = {}
+
+    def key(self, item, sippscen):
+        dirpath = sippscen.dirpath
+        if dirpath and dirpath not in self.dirhashes:
+            self.dirhashes[dirpath] = hash_scenario_dir(dirpath)
+
+        kwargs = getattr(item.obj, 'kwargs', {})
+        return (sippscen.pformat_cmds(),
+                self.dirhashes.get(dirpath),
+                repr(item.funcargs.get('sipp_proxyaddr')),
+                repr(item.funcargs.get('dut_ip')),
+                repr(sorted(kwargs.items())))
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_run_sipp_scenario(self, item, sippscen, sippargs):
+        item.sipp_memo_key = key = self.key(item, sippscen)
+        if key not in self.outcomes:
+            return
+
+        nodeid, metrics, exc = self.outcomes[key]
+        self.reused.append((item.nodeid, nodeid))
+        item.sipp_reused = nodeid
+        item.add_report_section('call', 'sipp',
+                                'Reused the outcome of {}'.format(nodeid))
+        if metrics is not None:
+            item.sipp_metrics = metrics
+        if exc is not None:
+            raise exc
+        return True
+
+    @pytest.hookimpl
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.reused:
+            return
+
+        terminalreporter.section('sipp reused runs')
+        for nodeid, source in self.reused:
+            terminalreporter.line('{} <- {}'.format(nodeid, source))
+
+
+class SIPpMemoRecorder(object):
+    """Record the outcome of every scenario run for :class:`SIPpMemo`.
+    """
+    def __init__(self, memo):
+        self.memo = memo
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_run_sipp_scenario(self, item, sippscen, sippargs):
+        outcome = yield
+        key = getattr(item, 'sipp_memo_key', None)
+        if key is None or key in self.memo.outcomes:
+            return
+
+        exc = outcome.excinfo[1] if outcome.excinfo else None
+        if isinstance(exc, (pytest.skip.Exception, pytest.fail.Exception)):
+            # Not a SIPp result, e.g. the DUT failed its probe
+            return
+
+        self.memo.outcomes[key] = (item.nodeid,
+                                   getattr(item, 'sipp_metrics', None),
+                                   exc)
+
+
+# Runtime flags searched by --sipp-calibrate, in search order
+TUNING_FLAGS = OrderedDict([
+    ('-max_socket', [1024, 10000, 50000]),
+    ('-buff_size', [65535, 1048576, 4194304]),
+    ('-timer_resol', [1, 10, 200]),
+    ('-max_recv_loops', [1000, 5000, 20000]),
+    ('-max_sched_loops', [1000, 5000, 20000]),
+])
+
+
+def tuning_cachekey():
+    import socket
+    return 'sipp/tuning/{}'.format(socket.gethostname())
+
+
+def tuned_flags(config):
+    """Return the flags calibrated for this host, if any.
+    """
+    if config.getoption('--sipp-no-tuning') or not getattr(
+            config, 'cache', None):
+        return {}
+    return config.cache.get(tuning_cachekey(), {}).get('flags', {})
+
+
+def calibration_trial(flags, rate, duration):
+    """Run the default scenario over loopback at ``rate`` calls per
+    second with ``flags`` and return the achieved rate, or 0 if the run
+    was not stable.
+    """
+    import pysipp
+    scen = pysipp.scenario()
+    scen.clientdefaults.rate = rate
+    scen.clientdefaults.limit = rate
+    scen.clientdefaults.call_count = int(rate * duration)
+
+    rundir = tempfile.mkdtemp(prefix='pytest-sipp-calibrate-')
+    scen.defaults.logdir = rundir
+    spawner = SIPpSpawner(rundir, flags=flags)
+    try:
+        scen(timeout=duration * 3,
+             runner=pysipp.launch.PopenRunner(subprocmod=spawner))
+        metrics = collect_metrics(spawner.statfiles, duration)
+    except (pysipp.SIPpFailure, pysipp.launch.TimeoutError):
+        return 0.0
+    finally:
+        shutil.rmtree(rundir, ignore_errors=True)
+
+    if metrics.get('failed_ratio', 1) > 0.001:
+        return 0.0
+    return metrics.get('cps', 0.0)
+
+
+def calibrate(config, session):
+    """Search TUNING_FLAGS one flag at a time for the highest stable call
+    rate on this host and store the result in the pytest cache.
+    """
+    import socket
+    if not getattr(config, 'cache', None):
+        raise pytest.UsageError('--sipp-calibrate needs the pytest cache')
+    tw = config.get_terminal_writer()
+    rate = config.getoption('--sipp-calibrate-rate')
+    duration = config.getoption('--sipp-calibrate-duration')
+
+    best = {}
+    best_cps = calibration_trial(best, rate, duration)
+    tw.line('SIPp defaults: {:.1f} cps'.format(best_cps))
+    for flag, values in TUNING_FLAGS.items():
+        for value in values:
+            candidate = dict(best)
+            candidate[flag] = value
+            cps = calibration_trial(candidate, rate, duration)
+            tw.line('{} {}: {:.1f} cps'.format(flag, value, cps))
+            # Ignore improvements within the noise of a single run
+            if cps > best_cps * 1.02:
+                best, best_cps = candidate, cps
+
+    config.cache.set(tuning_cachekey(), {'flags': best, 'cps': best_cps,
+                                         'rate': rate,
+                                         'calibrated': time.time()})
+    tw.line('Calibrated {} for {:.1f} cps: {}'.format(
+        socket.gethostname(), best_cps,
+        ' '.join('{} {}'.format(*flag) for flag in sorted(best.items()))
+        or 'SIPp defaults'), bold=True)
+
+
 def generate_sipp_tests(metafunc, scen_node, **kwargs):
+    import pysipp
     sipp_conf = getattr(metafunc.function, 'sipp_conf', None)
     if sipp_conf:
         settings = dict(sipp_conf.kwargs)
@@ -198,16 +1988,99 @@ def pytest_pyfunc_call(pyfuncitem):
     config.hook.pytest_run_sipp_scenario_post(item=pyfuncitem,
                                               sippscen=sippscen)
 
+    metrics = getattr(pyfuncitem, 'sipp_metrics', None)
+    if metrics:
+        config.hook.pytest_sipp_scenario_metrics(item=pyfuncitem,
+                                                 sippscen=sippscen,
+                                                 metrics=metrics)
+
     return True
 
 
 @pytest.hookimpl
 def pytest_run_sipp_scenario(item, sippscen, sippargs):
-    pytest.log.info('Launching SIPp scenario {}...'.format(sippscen.dirpath))
-    pytest.log.info('Running commands:\n{}'.format(sippscen.pformat_cmds()))
-
+    import pysipp
     timeout = sippargs.pop('timeout', 180)
-    sippscen(timeout=timeout, **sippargs)
+    soak = sippargs.pop('soak', None)
+    soak_checks = sippargs.pop('soak_checks', ())
+    procs = shard_count(sippargs.pop('procs', None))
+    injection = sippargs.pop('injection', None)
+    events = item.config.pluginmanager.getplugin('sipp-event-log')
+
+    watchdog = item.config.pluginmanager.getplugin('sipp-watchdog')
+
+    flags = dict(tuned_flags(item.config))
+    dump_interval = soak
+    if watchdog and watchdog.hang_timeout:
+        # Make sure agents dump their statistics often enough to tell
+        # a hung agent from a slow one
+        hang_interval = max(int(watchdog.hang_timeout / 3), 1)
+        if soak:
+            dump_interval = min(soak, hang_interval)
+        else:
+            flags['-fd'] = hang_interval
+    flags.update(sippargs.pop('sipp_flags', None) or {})
+
+    rundir = make_rundir(item)
+    item.sipp_rundir = rundir, sippscen, sippscen.defaults.logdir
+    if sippscen.defaults.logdir in (None, tempfile.gettempdir()):
+        sippscen.defaults.logdir = rundir
+
+    pytest.log.info('Launching SIPp scenario %s...',
+                    LazyFormat(getattr, sippscen, 'dirpath'))
+    pytest.log.info('Running commands:\n%s',
+                    LazyFormat(sippscen.pformat_cmds))
+
+    spawner = SIPpSpawner(rundir,
+                          ['-fd', str(dump_interval)] if soak else [],
+                          events=events, nodeid=item.nodeid, flags=flags,
+                          watchdog=watchdog)
+    try:
+        injection_shard = None
+        if injection is not None:
+            injection_shard = functools.partial(injection_shard_file,
+                                                item.config, injection)
+
+        if procs > 1:
+            runner = SIPpShards(sippscen, procs, spawner, injection_shard)
+            launch = runner.launch
+        else:
+            if injection is not None:
+                sippscen.clientdefaults.info_file = injection_file(
+                    item.config, injection)
+            if 'runner' not in sippargs:
+                sippargs['runner'] = new_runner(spawner)
+            runner = sippargs['runner']
+            launch = sippscen
+
+        start = time.time()
+        if soak:
+            run_soak(item, launch, runner, sippargs, timeout, soak,
+                     soak_checks, spawner.statfiles)
+        else:
+            launch(timeout=timeout, **sippargs)
+        item.sipp_metrics = collect_metrics(spawner.statfiles,
+                                            time.time() - start)
+    except pysipp.launch.TimeoutError:
+        if events:
+            events.emit('timeout', nodeid=item.nodeid, timeout=timeout,
+                        duration=time.time() - start)
+        raise
+
+
+def release_rundir(item):
+    """Archive (or delete) the run directory of ``item``'s scenario once
+    the test body and the post run hooks are done with its files.
+    """
+    rundir, sippscen, logdir = item.__dict__.pop('sipp_rundir')
+    # pysipp insists the log directory exists whenever the scenario is
+    # prepared, and the run directory is about to go
+    sippscen.defaults.logdir = logdir
+    archive = item.config.pluginmanager.getplugin('sipp-archive')
+    if archive:
+        archive.add(rundir, os.path.basename(rundir))
+    else:
+        shutil.rmtree(rundir, ignore_errors=True)
 
 
 def gensipptests(collector, name, testdescription):
@@ -279,6 +2152,169 @@ def pytest_addoption(parser):
         help="default port the dut listen's on for sip requests"
              " (eg. default sip profile port)"
     )
+    group.addoption(
+        '--sip-responder', action='store_true', default=False,
+        help='point sipp_proxyaddr at a local SIP responder instead of '
+             'the dut'
+    )
+    group.addoption(
+        '--sip-responder-delay', action='append', default=None,
+        metavar='METHOD=SECONDS',
+        help='hold back the local SIP responder\'s final answer to METHOD'
+    )
+    group.addoption(
+        '--sip-responder-error-rate', action='append', default=None,
+        metavar='METHOD=FRACTION',
+        help='fraction of METHOD requests the local SIP responder answers '
+             'with 503'
+    )
+    group.addoption(
+        '--sipp-calibrate', action='store_true', default=False,
+        help='search SIPp runtime flags for the highest stable call rate '
+             'over loopback on this host, store them and exit'
+    )
+    group.addoption(
+        '--sipp-calibrate-rate', action='store', default=2000, type=int,
+        metavar='CPS', help='call rate offered while calibrating'
+    )
+    group.addoption(
+        '--sipp-calibrate-duration', action='store', default=10,
+        type=float, metavar='SECONDS',
+        help='length of every calibration run'
+    )
+    group.addoption(
+        '--sipp-no-tuning', action='store_true', default=False,
+        help='do not apply the flags calibrated for this host'
+    )
+    group.addoption(
+        '--sipp-registry-dir', action='store', default=None,
+        metavar='PATH',
+        help='where sessions register their SIPp agents so later sessions '
+             'can kill orphans (defaults to the pytest cache)'
+    )
+    group.addoption(
+        '--sipp-hang-timeout', action='store', default=None, type=float,
+        metavar='SECONDS',
+        help='kill agents whose call counters do not move for this long'
+    )
+    group.addoption(
+        '--sipp-memoize', action='store_true', default=False,
+        help='reuse the outcome of identical scenario runs within the '
+             'session instead of launching SIPp again'
+    )
+    group.addoption(
+        '--sipp-event-log', action='store', default=None, metavar='PATH',
+        help='append a JSON line for every agent launch, exit, timeout '
+             'and SIPp test teardown to this file'
+    )
+    group.addoption(
+        '--sipp-probe', action='store_true', default=False,
+        help='probe sipp_proxyaddr with SIP OPTIONS before every scenario'
+    )
+    group.addoption(
+        '--sipp-probe-deadline', action='store', default=5.0, type=float,
+        metavar='SECONDS',
+        help='how long the DUT gets to answer a probe (default: 5)'
+    )
+    group.addoption(
+        '--sipp-probe-down', action='store', default='fail',
+        choices=('fail', 'skip'),
+        help='fail or skip every remaining scenario once the DUT stops '
+             'answering probes'
+    )
+    group.addoption(
+        '--sipp-baseline', action='store', default=None, metavar='NAME',
+        help='compare scenario metrics against the named baseline, '
+             'recording any scenario it does not know about yet'
+    )
+    group.addoption(
+        '--sipp-baseline-file', action='store', default=None,
+        metavar='PATH',
+        help='keep baselines in this JSON file instead of the pytest cache'
+    )
+    group.addoption(
+        '--sipp-baseline-update', action='store_true', default=False,
+        help='overwrite the baseline with the metrics of this run'
+    )
+    group.addoption(
+        '--sipp-tolerance', action='append', default=None,
+        metavar='METRIC=FRACTION',
+        help='allowed regression per metric before failing, one of: '
+             '{}'.format(', '.join(METRICS))
+    )
+    group.addoption(
+        '--sipp-regressions', action='store', default='fail',
+        choices=('fail', 'warn'),
+        help='whether a regression fails the test or only warns'
+    )
+    group.addoption(
+        '--sipp-rundir', action='store', default=None, metavar='PATH',
+        help='where every scenario gets its working directory '
+             '(defaults to /dev/shm when available)'
+    )
+    group.addoption(
+        '--sipp-archive-dir', action='store', default=None, metavar='PATH',
+        help='where the artifacts of each session are archived '
+             '(defaults to the pytest cache)'
+    )
+    group.addoption(
+        '--sipp-archive-keep', action='store', default=10, type=int,
+        metavar='N', help='number of session archives to keep (default: 10)'
+    )
+    group.addoption(
+        '--sipp-archive-max-size', action='store', default=1024, type=float,
+        metavar='MB',
+        help='total size session archives may use (default: 1024)'
+    )
+    group.addoption(
+        '--sipp-no-archive', action='store_true', default=False,
+        help='delete scenario artifacts instead of archiving them'
+    )
+    group.addoption(
+        '--sipp-injection-keep', action='store', default=20, type=int,
+        metavar='N',
+        help='number of cached injection files to keep (default: 20)'
+    )
+    group.addoption(
+        '--sipp-injection-max-size', action='store', default=1024,
+        type=float, metavar='MB',
+        help='total size cached injection files may use (default: 1024)'
+    )
+    group.addoption(
+        '--sipp-history', action='store', default=None, metavar='SCENARIO',
+        help='show the daily trend of a scenario\'s recorded runs and exit'
+    )
+    group.addoption(
+        '--sipp-history-days', action='store', default=30, type=float,
+        metavar='DAYS', help='how far back --sipp-history looks (default: 30)'
+    )
+    group.addoption(
+        '--sipp-history-db', action='store', default=None, metavar='PATH',
+        help='SQLite file every SIPp test outcome is recorded in '
+             '(defaults to the pytest cache)'
+    )
+    group.addoption(
+        '--sipp-history-dut', action='store', default=None, metavar='NAME',
+        help='identify the dut by NAME in the history instead of its '
+             'address'
+    )
+    group.addoption(
+        '--sipp-no-history', action='store_true', default=False,
+        help='do not record SIPp test outcomes'
+    )
+    group.addoption(
+        '--sipp-soak-dir', action='store', default=None, metavar='PATH',
+        help='where soak runs keep their checkpoint logs '
+             '(defaults to the pytest cache)'
+    )
+
+
+@pytest.hookimpl
+def pytest_cmdline_main(config):
+    if config.option.sipp_calibrate:
+        return wrap_session(config, calibrate)
+    if config.option.sipp_history:
+        return wrap_session(config, history_report)
 
 
 @pytest.hookimpl
@@ -292,10 +2328,82 @@ def pytest_configure(config):
         kwargs=dict(config=config)
     )
 
+    event_log = config.getoption('--sipp-event-log')
+    if event_log:
+        config.pluginmanager.register(SIPpEventLog(event_log),
+                                      'sipp-event-log')
+
+    if config.getoption('--sipp-probe'):
+        config.pluginmanager.register(SIPpProbe(config), 'sipp-probe')
+
+    if config.getoption('--sip-responder'):
+        config.pluginmanager.register(SIPResponderStandIn(),
+                                      'sip-responder-stand-in')
+
+    if config.getoption('--sipp-memoize'):
+        memo = SIPpMemo()
+        config.pluginmanager.register(memo, 'sipp-memo')
+        config.pluginmanager.register(SIPpMemoRecorder(memo),
+                                      'sipp-memo-recorder')
+
+    baseline = config.getoption('--sipp-baseline')
+    if baseline:
+        config.pluginmanager.register(SIPpBaseline(config, baseline),
+                                      'sipp-baseline')
+
+
+def sipp_dir(config, option, name):
+    """Return the directory given with ``option``, or else ``name`` in
+    the pytest cache, making sure it exists.
+    """
+    path = config.getoption(option)
+    if not path:
+        if not getattr(config, 'cache', None):
+            return None
+        return str(config.cache.makedir(name))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def activate(config):
+    """Register the plugins backing every SIPp test once the session
+    reaches its first one, so sessions without SIPp tests never touch
+    the file system.
+    """
+    if getattr(config, 'sipp_activated', False):
+        return
+    config.sipp_activated = True
+
+    registry = sipp_dir(config, '--sipp-registry-dir', 'sipp_registry')
+    if registry:
+        watchdog = SIPpWatchdog(registry,
+                                config.getoption('--sipp-hang-timeout'))
+        config.pluginmanager.register(watchdog, 'sipp-watchdog')
+        watchdog.start()
+
+    if not config.getoption('--sipp-no-archive'):
+        archive = sipp_dir(config, '--sipp-archive-dir', 'sipp_archive')
+        if archive:
+            max_size = config.getoption('--sipp-archive-max-size')
+            config.pluginmanager.register(
+                SIPpArchive(archive, config.getoption('--sipp-archive-keep'),
+                            int(max_size * 1024 * 1024)),
+                'sipp-archive')
+
+    if not config.getoption('--sipp-no-history'):
+        history = history_path(config)
+        if history:
+            config.pluginmanager.register(
+                SIPpHistory(history, config.getoption('--sipp-history-dut')),
+                'sipp-history')
+
 
 @pytest.hookimpl
 def pytest_pycollect_makeitem(collector, name, obj):
-    if collector.funcnamefilter(name) and isinstance(obj, SIPpTestDescription):
+    # Called for every object of every module, so test the cheap
+    # isinstance before pytest's name matching
+    if isinstance(obj, SIPpTestDescription) and collector.funcnamefilter(name):
         return list(gensipptests(collector, name, obj))
 
 
@@ -303,19 +2411,40 @@ def pytest_pycollect_makeitem(collector, name, obj):
 def pytest_generate_tests(metafunc):
     # Handle parameterization of regular tests that use the sippscen
     # fixture directly, instead of the sipp_test wrapper
-    if (not isinstance(metafunc.function, SIPpTestDescription)
-            and 'sippscen' in metafunc.funcargnames):
+    if ('sippscen' in metafunc.fixturenames
+            and not isinstance(metafunc.function, SIPpTestDescription)):
         generate_sipp_tests(metafunc, None)
 
 
 @pytest.fixture(scope='session')
 def sipp_proxyaddr(request, dut_ip):
     '''Return the dut's default sip profile socket.
-    (can be overridden from 5060 using --sip-port option)
+    (can be overridden from 5060 using --sip-port option, or replaced
+    by the local SIP responder using --sip-responder)
     '''
     return dut_ip, request.config.getoption('--sip-port')
 
 
+@pytest.fixture(scope='session')
+def sip_responder(request):
+    '''Return a running local SIP responder standing in for the dut.
+    '''
+    config = request.config
+    responder = SIPResponder(
+        delays=parse_method_values(
+            '--sip-responder-delay',
+            config.getoption('--sip-responder-delay')),
+        error_rates=parse_method_values(
+            '--sip-responder-error-rate',
+            config.getoption('--sip-responder-error-rate')))
+    try:
+        responder.start()
+    except ImportError:
+        pytest.skip('the local SIP responder needs asyncio')
+    yield responder
+    responder.stop()
+
+
 @pytest.fixture
 def scen_db_path(request):
     """The path to the root of the SIPp scenario database
@@ -326,6 +2455,14 @@ def scen_db_path(request):
     return SCENARIO_ROOT
 
 
+@pytest.fixture(scope='session')
+def sipp_injection(request):
+    """Return a function turning an :class:`InjectionSpec` into the path
+    of its (cached) injection file.
+    """
+    return functools.partial(injection_file, request.config)
+
+
 @pytest.fixture
 def sippscen(request):
     return request.param
@@ -333,11 +2470,23 @@ def sippscen(request):
 
 @pytest.hookimpl
 def pytest_runtest_protocol(item, nextitem):
-    if issipptest(item.obj) and not which('sipp'):
+    if isinstance(item, SIPpTest) and not which('sipp'):
         SIPpNotFound.makereport(item, when='setup')
         return True  # Do not continue with this test
 
 
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    if isinstance(item, SIPpTest):
+        activate(item.config)
+
+
+@pytest.hookimpl
+def pytest_runtest_teardown(item, nextitem):
+    if getattr(item, 'sipp_rundir', None):
+        release_rundir(item)
+
+
 @pytest.hookimpl
 def pytest_addhooks(pluginmanager):
     class SIPpHook:
@@ -352,4 +2501,8 @@ def pytest_addhooks(pluginmanager):
         def pytest_run_sipp_scenario_post(item, sippscen):
             """Post test hook"""
 
+        def pytest_sipp_scenario_metrics(item, sippscen, metrics):
+            """Inspect the metrics of a successful scenario run, called
+            after pytest_run_sipp_scenario_post"""
+
     pluginmanager.add_hookspecs(SIPpHook())
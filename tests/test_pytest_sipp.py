@@ -53,6 +53,68 @@ def sipp_testdir(testdir):
     return testdir
 
 
+STUB_SIPP = '''#!{python}
+import json
+import os
+import sys
+import time
+
+args = sys.argv[1:]
+with open({log!r}, 'a') as fp:
+    fp.write(json.dumps({{'cwd': os.getcwd(), 'args': args}}) + '\\n')
+
+calls = int(args[args.index('-m') + 1]) if '-m' in args else 1
+for flag, value in zip(args, args[1:]):
+    if flag == '-stf':
+        with open(value, 'w') as fp:
+            fp.write('TotalCallCreated;SuccessfulCall(C);FailedCall(C);'
+                     'CallRate(C);\\n{{0}};{{0}};0;10.0;\\n'.format(calls))
+    elif flag in ('-screen_file', '-log_file'):
+        with open(value, 'w') as fp:
+            fp.write(flag)
+time.sleep(float(os.environ.get('STUB_SIPP_DELAY', 0)))
+sys.exit(int(os.environ.get('STUB_SIPP_EXIT', 0)))
+'''
+
+
+@pytest.fixture
+def stub_sipp(testdir, monkeypatch):
+    """A testdir whose PATH leads to a stub SIPp logging every launch,
+    so SIPp tests go through the real pytest_run_sipp_scenario hook.
+    """
+    import json
+    import os
+    import sys
+
+    bindir = testdir.tmpdir.mkdir('bin')
+    launches = bindir.join('launches.jsonl')
+    sipp = bindir.join('sipp')
+    sipp.write(STUB_SIPP.format(python=sys.executable, log=str(launches)))
+    sipp.chmod(0o755)
+    monkeypatch.setenv('PATH', os.pathsep.join([str(bindir),
+                                                os.environ['PATH']]))
+
+    testdir.makeconftest('''
+        import logging
+        import pytest
+
+        # Normally provided by our pytest-logging plugin
+        pytest.log = logging.getLogger('sipp')
+
+        @pytest.fixture(scope='session')
+        def dut_ip():
+            return '127.0.0.1'
+    ''')
+
+    def read_launches():
+        if not launches.check():
+            return []
+        return [json.loads(line) for line in launches.readlines()]
+
+    testdir.launches = read_launches
+    return testdir
+
+
 def test_direct_decoration(sipp_testdir):
     sipp_testdir.makepyfile('''
         import pytest
@@ -247,3 +309,1080 @@ def test_sipp_missing(sipp_testdir):
     result.stdout.fnmatch_lines([
         '*Could not find a suitable SIPp binary. Is it installed properly?'
     ])
+
+
+STAT_HEADER = ('StartTime;CurrentTime;TotalCallCreated;CurrentCall;'
+               'SuccessfulCall(C);FailedCall(C);CallRate(C);'
+               'ResponseTimeRepartition1;ResponseTimeRepartition1_<10;'
+               'ResponseTimeRepartition1_<20;ResponseTimeRepartition1_>=20;')
+
+
+def test_collect_metrics(tmpdir):
+    from pytest_sipp import collect_metrics
+
+    uac = tmpdir.join('0-uac.csv')
+    uac.write('\n'.join([
+        STAT_HEADER,
+        'x;x;50;5;45;5;10.0;;10;30;5;',
+        'x;x;100;0;90;10;20.0;;50;40;10;',
+    ]))
+    uas = tmpdir.join('1-uas.csv')
+    uas.write('\n'.join([STAT_HEADER, 'x;x;100;0;100;0;20.0;;0;0;0;']))
+
+    metrics = collect_metrics({str(uac): 'uac', str(uas): 'uas'}, 12.5)
+    assert metrics == {
+        'duration': 12.5,
+        'calls': 100,
+        'successful': 90,
+        'failed': 10,
+        'failed_ratio': 0.1,
+        'cps': 20.0,
+        'rt_p50': 10,
+        'rt_p90': 20,
+        'rt_p99': 20,
+    }
+
+
+def test_compare_metrics():
+    from pytest_sipp import compare_metrics
+
+    baseline = {'duration': 10.0, 'cps': 100.0, 'failed_ratio': 0.0}
+    assert not compare_metrics(baseline, {'duration': 12.0, 'cps': 95.0})
+
+    regressions = compare_metrics(baseline, {'duration': 12.0, 'cps': 80.0,
+                                             'failed_ratio': 0.05},
+                                  {'duration': 0.1})
+    assert [r.split(':')[0] for r in regressions] == [
+        'duration', 'failed_ratio', 'cps']
+
+
+def test_baseline_regression(sipp_testdir):
+    sipp_testdir.makepyfile(sippmetrics='''
+        def pytest_run_sipp_scenario_post(item, sippscen):
+            item.sipp_metrics = {'duration': float(item.module.DURATION)}
+    ''')
+    test = '''
+        import pytest
+
+        DURATION = {}
+
+        @pytest.sipp_test
+        def test_sipp():
+            yield
+    '''
+    args = ('-v', '-p', 'sippmetrics', '--sipp-baseline', 'nightly')
+
+    sipp_testdir.makepyfile(test.format(10))
+    result = sipp_testdir.runpytest(*args)
+    result.stdout.fnmatch_lines(['*::test_sipp[[]default_sippscen] PASSED'])
+
+    sipp_testdir.makepyfile(test.format(11))
+    result = sipp_testdir.runpytest(*args)
+    result.stdout.fnmatch_lines(['*::test_sipp[[]default_sippscen] PASSED'])
+
+    sipp_testdir.makepyfile(test.format(20))
+    result = sipp_testdir.runpytest(*args)
+    result.stdout.fnmatch_lines([
+        '*::test_sipp[[]default_sippscen] FAILED',
+        "*regressed against baseline 'nightly'*",
+    ])
+
+    result = sipp_testdir.runpytest(*(args + ('--sipp-regressions=warn',)))
+    result.stdout.fnmatch_lines(['*::test_sipp[[]default_sippscen] PASSED'])
+
+    result = sipp_testdir.runpytest(*(args + ('-p', 'no:cacheprovider')))
+    result.stderr.fnmatch_lines(['*--sipp-baseline needs the pytest cache '
+                                 'or --sipp-baseline-file*'])
+
+
+def test_baseline_merges_concurrent_sessions(tmpdir):
+    import json
+    from collections import namedtuple
+    from pytest_sipp import SIPpBaseline
+
+    Item = namedtuple('Item', 'nodeid')
+
+    path = tmpdir.join('baselines.json')
+    path.write(json.dumps({'nightly': {'test_a': {'cps': 1.0}}}))
+
+    class Config(object):
+        def __init__(self, update):
+            self.options = {'--sipp-baseline-file': str(path),
+                            '--sipp-baseline-update': update,
+                            '--sipp-regressions': 'fail',
+                            '--sipp-tolerance': None}
+
+        def getoption(self, name):
+            return self.options[name]
+
+    # Both sessions load the baseline before either saves
+    first = SIPpBaseline(Config(True), 'nightly')
+    second = SIPpBaseline(Config(False), 'nightly')
+    first.pytest_sipp_scenario_metrics(Item('test_a'), None, {'cps': 2.0})
+    second.pytest_sipp_scenario_metrics(Item('test_b'), None, {'cps': 3.0})
+    first.save()
+    second.save()
+
+    assert json.loads(path.read())['nightly'] == {
+        'test_a': {'cps': 2.0}, 'test_b': {'cps': 3.0}}
+
+
+def test_history(sipp_testdir):
+    import sqlite3
+
+    sipp_testdir.makepyfile(sippmetrics='''
+        def pytest_run_sipp_scenario_post(item, sippscen):
+            item.sipp_metrics = {'duration': 10.0, 'calls': 100,
+                                 'failed': 1, 'cps': 9.5,
+                                 'failed_ratio': 0.01, 'rt_p99': 40}
+    ''')
+    sipp_testdir.makepyfile('''
+        import pytest
+
+        @pytest.sipp_test
+        def test_sipp():
+            yield
+    ''')
+    db = str(sipp_testdir.tmpdir.join('history.db'))
+    for _ in range(2):
+        sipp_testdir.runpytest('-p', 'sippmetrics', '--sipp-history-db', db,
+                               '--sipp-history-dut', 'lab-dut')
+
+    rows = sqlite3.connect(db).execute(
+        'SELECT scenario, dut, outcome, calls, failed FROM runs').fetchall()
+    assert rows == [('default_sippscen', 'lab-dut', 'passed', 100, 1)] * 2
+
+    result = sipp_testdir.runpytest('--sipp-history-db', db,
+                                    '--sipp-history', 'default_sippscen')
+    result.stdout.fnmatch_lines([
+        "Scenario 'default_sippscen', last 30 days",
+        '*      2      2      10.0s      9.5    1.00%     40ms',
+    ])
+    result = sipp_testdir.runpytest('--sipp-history-db', db,
+                                    '--sipp-history', 'nope')
+    result.stdout.fnmatch_lines([
+        "No runs of scenario 'nope' in the last 30 days",
+        'Recorded scenarios: default_sippscen',
+    ])
+
+
+def test_history_survives_killed_session(sipp_testdir):
+    import sqlite3
+
+    sipp_testdir.makepyfile('''
+        import os
+        import pytest
+
+        @pytest.sipp_test
+        def test_first():
+            yield
+
+        @pytest.sipp_test
+        def test_killed():
+            os._exit(1)
+            yield
+    ''')
+    db = str(sipp_testdir.tmpdir.join('history.db'))
+    result = sipp_testdir.runpytest_subprocess('--sipp-history-db', db)
+    assert result.ret == 1
+
+    rows = sqlite3.connect(db).execute(
+        'SELECT nodeid, outcome FROM runs').fetchall()
+    assert [(nodeid.split('::')[-1], outcome)
+            for nodeid, outcome in rows] == [
+        ('test_first[default_sippscen]', 'passed')]
+
+
+def test_soak_log_survives_crash(tmpdir):
+    from pytest_sipp import SoakCheckpoint, SoakLog
+
+    log = SoakLog(str(tmpdir.join('soak')))
+    log.append(SoakCheckpoint.marker(SoakCheckpoint.START))
+    for current in (10, 12, 11):
+        log.append(SoakCheckpoint(SoakCheckpoint.CHECKPOINT, 0, 100, 90, 0,
+                                  current, 5.0, 10.0))
+    log.append(SoakCheckpoint.marker(SoakCheckpoint.END))
+    log.append(SoakCheckpoint.marker(SoakCheckpoint.START))
+    log.append(SoakCheckpoint(SoakCheckpoint.CHECKPOINT, 0, 10, 10, 0,
+                              3, 5.0, 10.0))
+    # simulate a crash halfway through writing a checkpoint
+    with open(log.path, 'ab') as fp:
+        fp.write(b'\x01\x00\x00')
+
+    first, second = log.runs()
+    assert first.completed and first.checkpoints == 3
+    assert first.max_current == 12 and first.last.current == 11
+    assert not second.completed and second.checkpoints == 1
+    assert 'crashed' in str(second)
+
+
+def test_no_call_leak():
+    from pytest_sipp import SoakCheckpoint, SoakSummary, no_call_leak
+
+    check = no_call_leak(slack=5)
+    summary = SoakSummary(0)
+    with pytest.raises(AssertionError):
+        for current in (50, 52, 54, 56):
+            checkpoint = SoakCheckpoint(SoakCheckpoint.CHECKPOINT, 0, 0, 0,
+                                        0, current, 0.0, 0.0)
+            summary.update(checkpoint)
+            check(checkpoint, summary)
+    assert summary.last.current == 56
+
+
+@pytest.fixture
+def udp_responder(request):
+    import socket
+    import threading
+
+    host = getattr(request, 'param', '127.0.0.1')
+    try:
+        sock = socket.socket(
+            socket.AF_INET6 if ':' in host else socket.AF_INET,
+            socket.SOCK_DGRAM)
+        sock.bind((host, 0))
+    except socket.error:
+        pytest.skip('cannot listen on {}'.format(host))
+    requests = []
+
+    def respond():
+        while True:
+            try:
+                data, addr = sock.recvfrom(65535)
+            except socket.error:
+                return
+            requests.append(data)
+            sock.sendto(b'SIP/2.0 200 OK\r\nContent-Length: 0\r\n\r\n', addr)
+
+    thread = threading.Thread(target=respond)
+    thread.daemon = True
+    thread.start()
+    yield sock.getsockname(), requests
+    sock.close()
+
+
+@pytest.fixture
+def unused_udp_port():
+    import socket
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_probe_sip(udp_responder, unused_udp_port):
+    import time
+    from pytest_sipp import probe_sip
+
+    addr, requests = udp_responder
+    assert probe_sip(addr, deadline=1)
+    assert requests[0].startswith(b'OPTIONS sip:127.0.0.1:')
+
+    start = time.time()
+    assert not probe_sip(('127.0.0.1', unused_udp_port), deadline=0.5)
+    assert time.time() - start < 1
+
+
+@pytest.mark.parametrize('udp_responder', ['::1'], indirect=True)
+def test_probe_sip_ipv6(udp_responder):
+    from pytest_sipp import probe_sip
+
+    addr, requests = udp_responder
+    assert probe_sip(addr, deadline=1)
+    lines = requests[0].decode().split('\r\n')
+    port = addr[1]
+    assert lines[0] == 'OPTIONS sip:[::1]:{} SIP/2.0'.format(port)
+    assert lines[1].startswith('Via: SIP/2.0/UDP [::1]:')
+    assert lines[4] == 'To: <sip:[::1]:{}>'.format(port)
+
+
+def test_probe_skips_when_dut_down(sipp_testdir, unused_udp_port):
+    sipp_testdir.makepyfile('''
+        import pytest
+
+        @pytest.fixture(scope='session')
+        def dut_ip():
+            return '127.0.0.1'
+
+        @pytest.sipp_test
+        def test_first():
+            yield
+
+        @pytest.sipp_test
+        def test_second():
+            yield
+    ''')
+
+    result = sipp_testdir.runpytest(
+        '-v', '--sipp-probe', '--sipp-probe-deadline=0.5',
+        '--sipp-probe-down=skip', '--sip-port={}'.format(unused_udp_port))
+    result.stdout.fnmatch_lines([
+        '*::test_first[[]default_sippscen] SKIPPED',
+        '*::test_second[[]default_sippscen] SKIPPED',
+    ])
+    assert result.duration < 5
+
+
+def test_sip_responder():
+    import socket
+    from pytest_sipp import SIPResponder
+    pytest.importorskip('asyncio')
+
+    responder = SIPResponder(error_rates={'REFER': 1}).start()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(2)
+
+    def request(method):
+        sock.sendto((
+            '{0} sip:dut SIP/2.0\r\n'
+            'Via: SIP/2.0/UDP 127.0.0.1:5061;branch=z9hG4bK1\r\n'
+            'From: <sip:uac>;tag=1\r\n'
+            'To: <sip:dut>\r\n'
+            'Call-ID: 1@uac\r\n'
+            'CSeq: 1 {0}\r\n'
+            'Content-Length: 0\r\n\r\n').format(method).encode(),
+            responder.addr)
+        return sock.recv(65535).decode().split('\r\n')
+
+    try:
+        assert request('INVITE')[0] == 'SIP/2.0 100 Trying'
+        answer = sock.recv(65535).decode().split('\r\n')
+        assert answer[0] == 'SIP/2.0 200 OK'
+        assert 'Call-ID: 1@uac' in answer
+        assert answer[3].startswith('To: <sip:dut>;tag=')
+        assert answer[-2] == 'a=rtpmap:0 PCMU/8000'
+        assert request('OPTIONS')[0] == 'SIP/2.0 200 OK'
+        assert request('REFER')[0] == 'SIP/2.0 503 Service Unavailable'
+        assert responder.received['INVITE'] == 1
+    finally:
+        sock.close()
+        responder.stop()
+
+
+def test_sip_responder_stands_in_for_dut(sipp_testdir):
+    pytest.importorskip('asyncio')
+    sipp_testdir.makepyfile('''
+        import pytest
+
+        def test_proxyaddr(sipp_proxyaddr, sip_responder):
+            assert sipp_proxyaddr == sip_responder.addr
+
+        @pytest.sipp_test
+        def test_probed():
+            yield
+    ''')
+
+    result = sipp_testdir.runpytest('-v', '--sip-responder', '--sipp-probe')
+    result.stdout.fnmatch_lines([
+        '*::test_proxyaddr PASSED',
+        '*::test_probed[[]default_sippscen] PASSED',
+    ])
+
+
+def test_sipp_proxyaddr_per_dut(testdir):
+    testdir.makepyfile('''
+        import pytest
+
+        @pytest.fixture(scope='session', params=['10.0.0.1', '10.0.0.2'])
+        def dut_ip(request):
+            return request.param
+
+        def test_proxyaddr(dut_ip, sipp_proxyaddr):
+            assert sipp_proxyaddr == (dut_ip, 5060)
+    ''')
+
+    testdir.runpytest().assert_outcomes(passed=2)
+
+
+def test_event_log(tmpdir):
+    import json
+    from pytest_sipp import SIPpEventLog
+
+    path = tmpdir.join('events.jsonl')
+    events = SIPpEventLog(str(path))
+    events.emit('launch', nodeid='test_a', pid=1, args=[
+        'sipp', '-sn', 'uac', '-p', '5070', '-rsa', '10.0.0.1:5060',
+        '-trace_screen', '10.0.0.2:5060'])
+    events.emit('exit', nodeid='test_a', pid=1, returncode=0, duration=1.5)
+    events.close()
+
+    launch, exit = [json.loads(line) for line in path.readlines()]
+    assert launch['event'] == 'launch'
+    assert launch['cmd'].startswith('sipp -sn uac -p 5070')
+    assert launch['local_port'] == '5070'
+    assert launch['proxy'] == '10.0.0.1:5060'
+    assert launch['remote'] == '10.0.0.2:5060'
+    assert exit['returncode'] == 0 and exit['duration'] == 1.5
+
+
+def test_memoize(sipp_testdir):
+    sipp_testdir.makepyfile('''
+        import mock
+        import pytest
+
+        RUNS = []
+
+        @pytest.fixture
+        def sippscen(request):
+            sippscen = mock.MagicMock()
+            sippscen.dirpath = None
+            sippscen.abort = request.function.__name__.startswith('test_b')
+            sippscen.pformat_cmds.return_value = 'sipp {}'.format(
+                request.function.__name__[:6])
+            RUNS.append(request.function.__name__)
+            return sippscen
+
+        @pytest.sipp_test
+        def test_a1():
+            yield
+
+        @pytest.sipp_test
+        def test_a2():
+            yield
+
+        @pytest.sipp_test
+        def test_b1():
+            yield
+
+        @pytest.sipp_test
+        def test_b2():
+            yield
+    ''')
+
+    result = sipp_testdir.runpytest('-v', '--sipp-memoize')
+    result.stdout.fnmatch_lines([
+        '*::test_a1[[]default_sippscen] PASSED',
+        '*::test_a2[[]default_sippscen] PASSED',
+        '*::test_b1[[]default_sippscen] FAILED',
+        '*::test_b2[[]default_sippscen] FAILED',
+        '*sipp reused runs*',
+        '*::test_a2[[]default_sippscen] <- *::test_a1[[]default_sippscen]',
+        '*::test_b2[[]default_sippscen] <- *::test_b1[[]default_sippscen]',
+    ])
+
+
+def test_split_load():
+    from pytest_sipp import split_load
+
+    assert [split_load(10, 3, index) for index in range(3)] == [4, 3, 3]
+    assert sum(split_load(2001, 8, index) for index in range(8)) == 2001
+
+
+def test_split_injection_file(tmpdir):
+    from pytest_sipp import split_injection_file
+
+    source = tmpdir.join('subscribers.csv')
+    source.write('SEQUENTIAL\n' + ''.join(
+        'user{0};secret{0}\n'.format(index) for index in range(5)))
+
+    shards = split_injection_file(str(source), 2, str(tmpdir))
+    assert [open(path).read() for path in shards] == [
+        'SEQUENTIAL\nuser0;secret0\nuser2;secret2\nuser4;secret4\n',
+        'SEQUENTIAL\nuser1;secret1\nuser3;secret3\n',
+    ]
+
+
+def test_shards(tmpdir):
+    import pysipp
+    from pytest_sipp import SIPpShards, SIPpSpawner, media_ports
+
+    scen = pysipp.scenario(autolocalsocks=False)
+    scen.agents['uac'].local_port = 25070
+    scen.agents['uas'].local_port = 25071
+    scen.agents['uac'].media_port = 26000
+    scen.agents['uas'].media_port = 26004
+    scen.clientdefaults.update(rate=30, limit=5, call_count=100)
+
+    shards = SIPpShards(scen, 3, SIPpSpawner(str(tmpdir)))
+    agents = [shard.prepare() for shard in shards.scenarios]
+    assert [[ua.name for ua in shard] for shard in agents] == [
+        ['uas', 'uac'], ['uac'], ['uac'], ]
+
+    clients = [shard[-1] for shard in agents]
+    assert [ua.rate for ua in clients] == [10.0] * 3
+    assert [ua.limit for ua in clients] == [2, 2, 1]
+    assert [ua.call_count for ua in clients] == [34, 33, 33]
+
+    local_ports = [ua.local_port for shard in agents for ua in shard]
+    assert len(set(local_ports)) == len(local_ports) == 4
+    rtp_ports = [port for shard in agents for ua in shard
+                 for port in media_ports(ua.media_port)]
+    assert len(set(rtp_ports)) == len(rtp_ports) == 16
+
+
+def test_shards_limits(tmpdir):
+    import pysipp
+    from pytest_sipp import SIPpShards, SIPpSpawner
+
+    scen = pysipp.scenario(autolocalsocks=False)
+    scen.clientdefaults.update(limit=2, call_count=100)
+    with pytest.warns(UserWarning) as record:
+        shards = SIPpShards(scen, 4, SIPpSpawner(str(tmpdir)))
+    assert len(shards.scenarios) == 2
+    assert str(record[0].message).startswith(
+        'Running 2 instead of 4 SIPp processes')
+
+    servers = scen.from_agents([ua for ua in scen.prepare()
+                                if ua.is_server()])
+    with pytest.warns(UserWarning) as record:
+        shards = SIPpShards(servers, 4, SIPpSpawner(str(tmpdir)))
+    assert len(shards.scenarios) == 1
+    assert 'no client agents' in str(record[0].message)
+
+
+def test_shards_merge_failures(stub_sipp, monkeypatch):
+    stub_sipp.makepyfile('''
+        import pytest
+
+        @pytest.sipp_test(procs=2)
+        def test_sharded(sippscen):
+            sippscen.clientdefaults.update(limit=2, call_count=4)
+            yield
+    ''')
+    monkeypatch.setenv('STUB_SIPP_EXIT', '1')
+    # Every shard is up before the first failure stops the others
+    monkeypatch.setenv('STUB_SIPP_DELAY', '0.5')
+
+    result = stub_sipp.runpytest('-v')
+    result.stdout.fnmatch_lines([
+        '*::test_sharded[[]default_sippscen] FAILED',
+        '*SIPpFailure*',
+    ])
+    clients = [launch['args'] for launch in stub_sipp.launches()
+               if 'uac' in launch['args']]
+    assert len(clients) == 2
+    for args in clients:
+        assert args[args.index('-m') + 1] == '2'
+        assert args[args.index('-l') + 1] == '1'
+
+
+def test_injection_spec(tmpdir):
+    from pytest_sipp import InjectionSpec
+
+    spec = InjectionSpec(5, ['sub{n:03d}', '{ext}'], start=1,
+                         ranges={'ext': (2000, 10)})
+    path = tmpdir.join('subscribers.csv')
+    spec.write(str(path))
+    assert path.read() == ('SEQUENTIAL\nsub001;2000\nsub002;2010\n'
+                           'sub003;2020\nsub004;2030\nsub005;2040\n')
+
+    shards = [spec.shard(index, 2) for index in range(2)]
+    assert [list(shard.lines()) for shard in shards] == [
+        ['sub001;2000\n', 'sub002;2010\n', 'sub003;2020\n'],
+        ['sub004;2030\n', 'sub005;2040\n'],
+    ]
+    assert len(set([spec.digest()] + [s.digest() for s in shards])) == 3
+
+
+def test_sipp_injection_cached(testdir):
+    testdir.makepyfile('''
+        import os
+        from pytest_sipp import InjectionSpec
+
+        def test_generate(sipp_injection):
+            path = sipp_injection(InjectionSpec(3, ['user{n}']))
+            assert open(path).read() == 'SEQUENTIAL\\nuser0\\nuser1\\nuser2\\n'
+            print('inode={}'.format(os.stat(path).st_ino))
+    ''')
+
+    first = testdir.runpytest('-s')
+    first.assert_outcomes(passed=1)
+    second = testdir.runpytest('-s')
+    second.assert_outcomes(passed=1)
+    # Generated files are renamed into place
+    inodes = [line.split('inode=')[1].split()[0]
+              for result in (first, second)
+              for line in result.outlines if 'inode=' in line]
+    assert len(inodes) == 2 and inodes[0] == inodes[1]
+
+
+def test_sipp_injection_needs_cache(testdir):
+    testdir.makepyfile('''
+        from pytest_sipp import InjectionSpec
+
+        def test_generate(sipp_injection):
+            sipp_injection(InjectionSpec(3, ['user{n}']))
+    ''')
+
+    result = testdir.runpytest('-p', 'no:cacheprovider')
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(['*injection files need the pytest cache*'])
+
+
+def test_sipp_injection_cache_retention(testdir, monkeypatch):
+    testdir.makepyfile('''
+        import os
+        from pytest_sipp import InjectionSpec
+
+        def test_generate(sipp_injection):
+            for name in os.environ['SPECS'].split():
+                sipp_injection(InjectionSpec(3, [name + '{n}']))
+    ''')
+
+    def cached():
+        cachedir = testdir.tmpdir.join('.cache', 'd', 'sipp_injection')
+        return sorted(open(str(path)).read().split()[1]
+                      for path in cachedir.listdir())
+
+    monkeypatch.setenv('SPECS', 'a b c')
+    testdir.runpytest().assert_outcomes(passed=1)
+    assert cached() == ['a0', 'b0', 'c0']
+    # Drops the least recently used file
+    monkeypatch.setenv('SPECS', 'a')
+    testdir.runpytest('--sipp-injection-keep', '2').assert_outcomes(passed=1)
+    assert cached() == ['a0', 'c0']
+    monkeypatch.setenv('SPECS', 'c')
+    testdir.runpytest('--sipp-injection-max-size',
+                      '0.00001').assert_outcomes(passed=1)
+    assert cached() == ['c0']
+
+
+def test_spawner_applies_tuning_flags(tmpdir):
+    from pytest_sipp import SIPpSpawner
+
+    spawner = SIPpSpawner(str(tmpdir), flags={'-max_socket': 50000,
+                                              '-buff_size': 1048576})
+    proc = spawner.Popen(['echo', '-sn', 'uac', '-max_socket', '100'],
+                         stdout=spawner.PIPE)
+    stdout, _ = proc.communicate()
+
+    args = stdout.decode().split()
+    assert args[:4] == ['-sn', 'uac', '-max_socket', '100']
+    assert args.count('-max_socket') == 1
+    assert args[-2:] == ['-buff_size', '1048576']
+    assert list(spawner.statfiles.values()) == ['uac']
+
+
+def test_spawner_runs_agents_from_rundir(tmpdir):
+    import os
+    from pytest_sipp import SIPpSpawner
+
+    spawner = SIPpSpawner(str(tmpdir))
+    proc = spawner.Popen(['sh', '-c', 'pwd; echo "$@"', 'sh',
+                          '-sf', 'uac.xml'], stdout=spawner.PIPE)
+    stdout, _ = proc.communicate()
+
+    cwd, args = stdout.decode().splitlines()
+    assert os.path.realpath(cwd) == os.path.realpath(str(tmpdir))
+    assert args.split()[:2] == ['-sf', os.path.abspath('uac.xml')]
+
+
+def test_archive(tmpdir):
+    import os
+    import zipfile
+    from pytest_sipp import SIPpArchive
+
+    archives = tmpdir.mkdir('archives')
+    for age, size in ((3, 10), (2, 2000), (1, 10)):
+        old = archives.join('sipp-old{}.zip'.format(age))
+        old.write('x' * size)
+        old.setmtime(old.mtime() - age * 60)
+
+    rundir = tmpdir.mkdir('run')
+    rundir.join('uac_screen_file').write('screen')
+    rundir.mkdir('scratch').join('users-0.csv').write('SEQUENTIAL\n')
+    archive = SIPpArchive(str(archives), keep=3, max_size=1000)
+    archive.add(str(rundir), 'test_basic')
+    archive.close()
+    archive.prune()
+
+    assert not rundir.check()
+    with zipfile.ZipFile(archive.path) as fp:
+        assert fp.namelist() == ['test_basic/uac_screen_file']
+        assert fp.read('test_basic/uac_screen_file') == b'screen'
+    # Only the newest two fit within the count and the size limit
+    assert sorted(os.listdir(str(archives))) == [
+        os.path.basename(archive.path), 'sipp-old1.zip']
+
+
+def test_prune_files_tolerates_concurrent_pruning(tmpdir, monkeypatch):
+    import os
+    from pytest_sipp import prune_files
+
+    paths = []
+    for age in range(3):
+        path = tmpdir.join('sipp-{}.zip'.format(age))
+        path.write('x')
+        path.setmtime(path.mtime() - age * 60)
+        paths.append(path)
+
+    remove = os.remove
+
+    def racing_remove(path):
+        # Another worker removes the file first
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(os, 'remove', racing_remove)
+    prune_files([str(path) for path in paths] +
+                [str(tmpdir.join('sipp-gone.zip'))], keep=1)
+    assert tmpdir.listdir() == [paths[0]]
+
+
+def test_watchdog_reaps_orphans(tmpdir):
+    import json
+    import subprocess
+    from pytest_sipp import SIPpWatchdog
+
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    orphan = subprocess.Popen(['sleep', '30'])
+    bystander = subprocess.Popen(['sleep', '30'])
+    tmpdir.join('{}.json'.format(dead.pid)).write(json.dumps({
+        'owner': dead.pid,
+        'agents': {
+            str(orphan.pid): {'cmd': 'sleep 30'},
+            # a recycled pid now belonging to something else
+            str(bystander.pid): {'cmd': 'sipp -sn uac'},
+        },
+    }))
+
+    watchdog = SIPpWatchdog(str(tmpdir))
+    try:
+        watchdog.reap_orphans()
+        assert orphan.wait() != 0
+        assert bystander.poll() is None
+    finally:
+        bystander.kill()
+    assert [pid for pid, _ in watchdog.reaped] == [orphan.pid]
+    assert not tmpdir.listdir()
+
+
+def test_watchdog_skips_bad_registries(tmpdir, monkeypatch):
+    import errno
+    import json
+    import os
+    import subprocess
+    from pytest_sipp import SIPpWatchdog
+
+    tmpdir.join('garbage.json').write('{"owner"')
+    tmpdir.join('ownerless.json').write(json.dumps({'agents': {}}))
+    tmpdir.join('agentless.json').write(json.dumps({'owner': [1]}))
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    tmpdir.join('{}.json'.format(dead.pid)).write(json.dumps({
+        'owner': dead.pid, 'agents': {}}))
+
+    remove = os.remove
+
+    def remove_concurrently(path):
+        # Another session starting alongside removes it first
+        remove(path)
+        raise OSError(errno.ENOENT, 'No such file or directory', path)
+
+    monkeypatch.setattr(os, 'remove', remove_concurrently)
+    SIPpWatchdog(str(tmpdir)).reap_orphans()
+    assert sorted(tmpdir.listdir(), key=str) == [
+        tmpdir.join(name)
+        for name in ('agentless.json', 'garbage.json', 'ownerless.json')]
+
+
+def test_watchdog_kills_hung_agents(tmpdir):
+    import json
+    from pytest_sipp import SIPpProcess, SIPpWatchdog
+
+    watchdog = SIPpWatchdog(str(tmpdir), hang_timeout=0.5)
+    watchdog.start()
+    proc = SIPpProcess(['sleep', '30'], watchdog=watchdog)
+    with open(watchdog.path) as fp:
+        assert list(json.load(fp)['agents']) == [str(proc.pid)]
+
+    assert proc.wait() != 0
+    proc.communicate()
+    watchdog.pytest_sessionfinish(None)
+    assert [pid for pid, _ in watchdog.hung] == [proc.pid]
+    assert not tmpdir.listdir()
+
+
+def test_plain_session_skips_pysipp(testdir):
+    testdir.makepyfile('''
+        import sys
+
+        def test_plain(request):
+            assert 'pytest_sipp' in sys.modules
+            assert 'pysipp' not in sys.modules
+            for name in ('watchdog', 'archive', 'history'):
+                plugin = 'sipp-' + name
+                assert not request.config.pluginmanager.getplugin(plugin)
+    ''')
+
+    result = testdir.runpytest_subprocess()
+    assert result.ret == 0
+    assert not testdir.tmpdir.join('.cache', 'd').check()
+
+
+def test_rundir_outlives_post_hooks(stub_sipp, tmpdir):
+    import os
+    import zipfile
+
+    stub_sipp.makepyfile(sipppost='''
+        import os
+
+        def pytest_run_sipp_scenario_post(item, sippscen):
+            for ua in sippscen.prepare():
+                assert os.path.exists(ua.screen_file)
+    ''')
+    stub_sipp.makepyfile('''
+        import logging
+        import pytest
+
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        pytest.log.addHandler(handler)
+        pytest.log.setLevel(logging.INFO)
+
+        @pytest.sipp_test
+        def test_logs(sippscen):
+            yield
+            screen_file = sippscen.prepare()[0].screen_file
+            assert open(screen_file).read() == '-screen_file'
+            # The logged commands are the ones the agents ran with
+            assert screen_file in messages[-1]
+    ''')
+
+    result = stub_sipp.runpytest('-v', '-p', 'sipppost',
+                                 '--sipp-archive-dir', str(tmpdir))
+    result.stdout.fnmatch_lines(['*::test_logs[[]default_sippscen] PASSED'])
+
+    rundir = stub_sipp.launches()[0]['cwd']
+    assert not os.path.exists(rundir)
+    archive, = tmpdir.listdir()
+    with zipfile.ZipFile(str(archive)) as fp:
+        names = [name.split('/', 1)[1] for name in fp.namelist()]
+    assert sorted(names) == ['0-uas.csv', '1-uac.csv', 'uac_log_file',
+                             'uac_screen_file', 'uas_log_file',
+                             'uas_screen_file']
+
+
+def test_runner_from_pysipp_hook(stub_sipp):
+    import pysipp
+
+    runners = []
+
+    class RecordingRunner(pysipp.launch.PopenRunner):
+        def __init__(self):
+            super(RecordingRunner, self).__init__()
+            runners.append(self)
+
+    class Plugin(object):
+        @pysipp.plugin.hookimpl
+        def pysipp_new_runner(self):
+            return RecordingRunner()
+
+    stub_sipp.makepyfile(sippmetrics='''
+        def pytest_sipp_scenario_metrics(item, sippscen, metrics):
+            assert metrics['calls'] == 1
+            assert metrics['cps'] == 10.0
+    ''')
+    stub_sipp.makepyfile('''
+        import pytest
+
+        @pytest.sipp_test
+        def test_hook():
+            yield
+    ''')
+
+    plugin = Plugin()
+    pysipp.plugin.mng.register(plugin)
+    try:
+        result = stub_sipp.runpytest('-v', '-p', 'sippmetrics',
+                                     '--sipp-no-archive')
+    finally:
+        pysipp.plugin.mng.unregister(plugin)
+    result.stdout.fnmatch_lines(['*::test_hook[[]default_sippscen] PASSED'])
+
+    runner, = runners
+    launches = stub_sipp.launches()
+    assert len(launches) == 2
+    for launch in launches:
+        assert '-trace_stat' in launch['args']
+        assert launch['cwd'] in launch['args'][launch['args'].index('-stf')
+                                               + 1]
+
+
+def test_calibration_trial_cleans_up(stub_sipp):
+    import os
+    from pytest_sipp import calibration_trial
+
+    assert calibration_trial({'-max_socket': 1024}, 10, 0.1) == 10.0
+    launches = stub_sipp.launches()
+    assert len(launches) == 2
+    for launch in launches:
+        args = launch['args']
+        assert args[args.index('-max_socket') + 1] == '1024'
+        for flag in ('-screen_file', '-log_file'):
+            path = args[args.index(flag) + 1]
+            assert os.path.dirname(path) == launch['cwd']
+        assert not os.path.exists(launch['cwd'])
+
+
+@pytest.mark.parametrize('option, expected', [
+    ((), [{'-max_socket': '512', '-buff_size': '2048'},
+          {'-max_socket': '512', '-buff_size': '4096'}]),
+    (('--sipp-no-tuning',), [{}, {'-buff_size': '4096'}]),
+])
+def test_tuned_flags_in_launch(stub_sipp, option, expected):
+    stub_sipp.makepyfile(sipptuning='''
+        from pytest_sipp import tuning_cachekey
+
+        def pytest_configure(config):
+            config.cache.set(tuning_cachekey(), {
+                'flags': {'-max_socket': 512, '-buff_size': 2048}})
+    ''')
+    stub_sipp.makepyfile('''
+        import pytest
+
+        @pytest.sipp_test
+        def test_tuned():
+            yield
+
+        @pytest.sipp_test(sipp_flags={'-buff_size': 4096})
+        def test_overridden():
+            yield
+    ''')
+
+    result = stub_sipp.runpytest('-v', '-p', 'sipptuning',
+                                 '--sipp-no-archive', *option)
+    result.stdout.fnmatch_lines(['*::test_tuned[[]default_sippscen] PASSED',
+                                 '*::test_overridden[[]default_sippscen] '
+                                 'PASSED'])
+
+    launches = stub_sipp.launches()
+    assert len(launches) == 4
+    for launch, flags in zip(launches, [expected[0]] * 2 + [expected[1]] * 2):
+        args = launch['args']
+        for flag in ('-max_socket', '-buff_size'):
+            assert (args[args.index(flag) + 1] if flag in args else None) \
+                == flags.get(flag)
+
+
+def test_memoized_runs_skip_baseline_and_history(stub_sipp):
+    import json
+    import sqlite3
+
+    stub_sipp.makepyfile('''
+        import pytest
+
+        @pytest.sipp_test
+        def test_first():
+            yield
+
+        @pytest.sipp_test
+        def test_again():
+            yield
+    ''')
+
+    history = stub_sipp.tmpdir.join('history.db')
+    result = stub_sipp.runpytest('-v', '--sipp-memoize', '--sipp-no-archive',
+                                 '--sipp-baseline', 'nightly',
+                                 '--sipp-history-db', str(history))
+    result.stdout.fnmatch_lines([
+        '*::test_first[[]default_sippscen] PASSED',
+        '*::test_again[[]default_sippscen] PASSED',
+        '*::test_again[[]default_sippscen] <- '
+        '*::test_first[[]default_sippscen]',
+    ])
+    assert len(stub_sipp.launches()) == 2
+
+    baseline = json.loads(stub_sipp.tmpdir.join(
+        '.cache', 'v', 'sipp', 'baseline', 'nightly').read())
+    assert [nodeid.split('::')[-1] for nodeid in baseline] == [
+        'test_first[default_sippscen]']
+
+    db = sqlite3.connect(str(history))
+    try:
+        nodeids = [row[0] for row in db.execute('SELECT nodeid FROM runs')]
+    finally:
+        db.close()
+    assert [nodeid.split('::')[-1] for nodeid in nodeids] == [
+        'test_first[default_sippscen]']
+
+
+def test_without_cache(stub_sipp):
+    stub_sipp.makepyfile('''
+        import pytest
+
+        @pytest.sipp_test
+        def test_sipp():
+            yield
+    ''')
+
+    result = stub_sipp.runpytest('-v', '-p', 'no:cacheprovider')
+    result.stdout.fnmatch_lines(['*::test_sipp[[]default_sippscen] PASSED'])
+    assert len(stub_sipp.launches()) == 2
+
+
+def test_soak_needs_cache_or_dir(stub_sipp, tmpdir):
+    stub_sipp.makepyfile('''
+        import pytest
+
+        @pytest.sipp_test(soak=1)
+        def test_soak():
+            yield
+    ''')
+
+    result = stub_sipp.runpytest('-p', 'no:cacheprovider')
+    result.stdout.fnmatch_lines(['*soak runs need the pytest cache or '
+                                 '--sipp-soak-dir*'])
+    assert not stub_sipp.launches()
+    result = stub_sipp.runpytest('-v', '-p', 'no:cacheprovider',
+                                 '--sipp-soak-dir', str(tmpdir))
+    result.stdout.fnmatch_lines(['*::test_soak[[]default_sippscen] PASSED'])
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_soak_dumps_often_enough_for_watchdog(stub_sipp):
+    stub_sipp.makepyfile('''
+        import pytest
+
+        @pytest.sipp_test(soak=300)
+        def test_soak():
+            yield
+    ''')
+
+    result = stub_sipp.runpytest('-v', '--sipp-hang-timeout', '60')
+    result.stdout.fnmatch_lines(['*::test_soak[[]default_sippscen] PASSED'])
+    for launch in stub_sipp.launches():
+        args = launch['args']
+        assert args.count('-fd') == 1
+        assert args[args.index('-fd') + 1] == '20'
+
+
+def test_soak_run(stub_sipp, monkeypatch, tmpdir):
+    import time
+    from pytest_sipp import SoakLog
+
+    stub_sipp.makepyfile('''
+        import pytest
+
+        def calls_failed(checkpoint, summary):
+            assert summary.checkpoints < 2, 'calls failed'
+
+        @pytest.sipp_test(timeout=3, soak=1)
+        def test_soak():
+            yield
+
+        @pytest.sipp_test(timeout=60, soak=1, soak_checks=[calls_failed])
+        def test_soak_check():
+            yield
+    ''')
+    monkeypatch.setenv('STUB_SIPP_DELAY', '30')
+
+    started = time.time()
+    result = stub_sipp.runpytest('-v', '--sipp-soak-dir', str(tmpdir))
+    result.stdout.fnmatch_lines([
+        '*::test_soak[[]default_sippscen] PASSED',
+        '*::test_soak_check[[]default_sippscen] FAILED',
+        '*AssertionError: calls failed*',
+    ])
+    # Neither run waited for its agents
+    assert time.time() - started < 20
+
+    (check,), (soak,) = [list(SoakLog(str(path)).runs())
+                         for path in sorted(tmpdir.listdir())]
+    assert soak.completed and soak.checkpoints >= 2
+    assert soak.last.created == 1
+    assert check.completed and check.checkpoints == 2